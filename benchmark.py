@@ -0,0 +1,325 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import function
+import strategies
+
+
+class LegacyTask(object):
+    """
+    Constructor and string form of the baseline `function.Task`, as built by `legacy_load_instance`. Its default
+    `future_profits` list is shared by all tasks, so the reader appends the profits of all tasks to one list.
+    """
+
+    def __init__(self, name, weights, profits, poss_agents, future_profits=[]):
+        self.name = name
+        self.weights = OrderedDict(zip(poss_agents, weights))
+        self.profits = OrderedDict(zip(poss_agents, profits))
+        self.affinities = OrderedDict([(name, 1) for name in poss_agents])
+        self.future_profits = future_profits
+        self.history = []
+        self.backup_profits = None
+
+    def __str__(self):
+        weights = ",".join(map(str, self.weights.values()))
+        prios = ",".join(map(str, self.profits.values()))
+        poss_agents = ",".join(map(str, self.profits.keys()))
+        stringrep = "task(%d,[%s],[%s],[%s])." % (self.name, weights, prios,
+                                                  poss_agents)
+        return stringrep
+
+
+def legacy_load_instance(instance):
+    """ The baseline regex-based reader that `function.load_instance` replaced, verbatim, as reference """
+    tasks = {}
+    agents = {}
+    task_avail = []
+    agent_avail = []
+    profits = []
+    assignments = {}
+
+    task_regex = re.compile(
+        r"task\((?P<name>\d+),(?P<weights>\[[\d,\s]+\]),(?P<profits>\[[\d,\s]+\]),(?P<poss_agents>\[[\d,\s]*\])\)")
+    agent_regex = re.compile(r"agent\((?P<name>\d+),(?P<capacity>\d+)\)")
+    assign_regex = re.compile(r"assignment\((?P<name>\d+),(?P<assigned_tasks>\[[\d,\s]*\])\)")
+    avail_regex = re.compile(r"(?P<type>(task|agent)avail)\((?P<cycle>\d+),(?P<availabilities>\[[\d,\s]*\])\)")
+    profit_regex = re.compile(r"profit\((?P<cycle>\d+),(?P<profits>[\d\s,\[\]]*)\).")
+
+    for line in open(instance, 'r'):
+        line = line.replace(' ', '')
+
+        m = task_regex.match(line)
+        if m:
+            name = int(m.group('name'))
+            weights = json.loads(m.group('weights'))
+            poss_agents = json.loads(m.group('poss_agents'))
+            prios = json.loads(m.group('profits'))
+
+            assert (len(weights) == len(poss_agents))
+            assert (len(prios) == len(poss_agents))
+            assert (name not in tasks)
+
+            t = LegacyTask(name, weights, prios, poss_agents)
+            tasks[name] = t
+
+        m = agent_regex.match(line)
+
+        if m:
+            name = int(m.group('name'))
+            capacity = int(m.group('capacity'))
+
+            assert (capacity > 0)
+            assert (name not in agents)
+
+            a = function.Agent(name, capacity)
+            agents[name] = a
+
+        m = avail_regex.match(line)
+
+        if m and m.group('type') == 'taskavail':
+            cycle = int(m.group('cycle'))
+            availabilities = json.loads(m.group('availabilities'))
+            task_avail.insert(cycle - 1, availabilities)
+        elif m and m.group('type') == 'agentavail':
+            cycle = int(m.group('cycle'))
+            availabilities = json.loads(m.group('availabilities'))
+            agent_avail.insert(cycle - 1, availabilities)
+
+        m = assign_regex.match(line)
+
+        if m:
+            agent = int(m.group('name'))
+            assigned_tasks = json.loads(m.group('assigned_tasks'))
+            assignments[agent] = assigned_tasks
+
+        m = profit_regex.match(line)
+
+        if m:
+            cycle = int(m.group('cycle'))
+            prof = json.loads(m.group('profits'))
+            profits.append((cycle, prof))
+
+    if len(profits) > 0:
+        assert (len(profits) == len(task_avail) - 1)
+
+        for _, prof in sorted(profits, key=lambda x: x[0]):
+            for t, p in zip(tasks, prof):
+                tasks[t].future_profits.append(p)
+
+    assert (len(task_avail) == len(agent_avail))
+    assert (all(len(x) <= len(tasks) for x in task_avail))
+    assert (all(len(x) <= len(agents) for x in agent_avail))
+
+    return tasks, agents, task_avail, agent_avail, assignments
+
+
+def legacy_wpp_profits(tasks, agents, individual_weights=False):
+    """ Per-task loop that `WeightedPartialProfits.values` replaced, kept as reference; returns values and weights """
+    profits, affinities = strategies.Strategy.profits_and_affs(tasks, agents)
+
+    prio_max = np.max([p.max() for p in profits])
+    aff_max = np.max([a.max() for a in affinities])
+
+    weights = []
+
+    if not individual_weights:
+        ideal_sum = np.sum([t.ideal_affinity_sum(agents) for t in tasks])
+        actual_sum = np.sum([t.affinity_sum(agents) for t in tasks])
+        weight = ideal_sum / actual_sum
+        weight = np.minimum(weight, 1)
+        weights.append(weight)
+
+    values = []
+
+    for (t, prio, aff) in zip(tasks, profits, affinities):
+        aff *= np.min(aff[aff > 0])
+
+        if individual_weights:
+            weight = t.ideal_affinity_sum(agents) / np.sum(aff[aff > 0])
+            weight = min(weight, 1)
+            weights.append(weight)
+
+        p = (weight * prio / prio_max + (1 - weight) * aff / aff_max) * 1000
+
+        assert (0 <= weight <= 1)
+        assert (np.all(p > 0))
+
+        values.append(p.astype(int))
+
+    return values, weights
+
+
+def legacy_future_profits(tasks, nb_cycles):
+    """
+    Future profits of each task read by `legacy_load_instance`: the last `nb_cycles` cycles of the shared list, which
+    holds the profits of all tasks cycle by cycle and keeps growing with every call
+    """
+    shared = next(iter(tasks.values())).future_profits if tasks else []
+    recent = shared[len(shared) - nb_cycles * len(tasks):] if nb_cycles > 0 else []
+
+    return {t: recent[i::len(tasks)] for i, t in enumerate(tasks)}
+
+
+def same_instance(legacy, b):
+    tasks_a, agents_a, ta_a, aa_a, as_a = legacy
+    tasks_b, agents_b, ta_b, aa_b, as_b = b
+    nb_cycles = len(next(iter(tasks_b.values())).future_profits) if tasks_b else 0
+    profits_a = legacy_future_profits(tasks_a, nb_cycles)
+
+    return (list(tasks_a) == list(tasks_b) and
+            all(str(tasks_a[t]) == str(tasks_b[t]) and profits_a[t] == list(tasks_b[t].future_profits)
+                for t in tasks_a) and
+            [str(x) for x in agents_a.values()] == [str(x) for x in agents_b.values()] and
+            ta_a == ta_b and aa_a == aa_b and as_a == as_b)
+
+
+def timed(fn, *args, repeats=3):
+    durations = []
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(*args)
+        durations.append(time.perf_counter() - start)
+
+    return result, min(durations)
+
+
+def bench_parse(files, repeats):
+    print('instance;size_kb;legacy_s;parser_s;speedup;parser_mb_s;cached_s;identical')
+    total_size, total_legacy, total_parser, total_cached = 0, 0.0, 0.0, 0.0
+
+    for f in files:
+        size = os.path.getsize(f)
+        legacy, legacy_time = timed(legacy_load_instance, f, repeats=repeats)
+        parsed, parser_time = timed(function.load_instance, f, False, repeats=repeats)
+        cached, cached_time = timed(function.load_instance, f, True, repeats=repeats)
+
+        total_size += size
+        total_legacy += legacy_time
+        total_parser += parser_time
+        total_cached += cached_time
+
+        print('%s;%d;%.4f;%.4f;%.1f;%.1f;%.4f;%s' % (os.path.basename(f), size / 1024, legacy_time, parser_time,
+                                                      legacy_time / parser_time, size / 2 ** 20 / parser_time,
+                                                      cached_time,
+                                                      same_instance(legacy, parsed) and same_instance(legacy, cached)))
+
+    print('total;%d;%.4f;%.4f;%.1f;%.1f;%.4f;' % (total_size / 1024, total_legacy, total_parser,
+                                                  total_legacy / total_parser, total_size / 2 ** 20 / total_parser,
+                                                  total_cached))
+
+
+def bench_wpp(files, repeats):
+    """
+    Runs both WPP implementations on every cycle of the instances. Affinities evolve by assigning each task
+    to its most valuable agent, ignoring capacities, which is enough to exercise the weights.
+    """
+    print('instance;mode;cycles;legacy_s;vectorized_s;speedup;identical')
+
+    for f in files:
+        for individual_weights in (False, True):
+            source = function.CycleSource(f, cache=True)
+            table = source.table
+            strategy = strategies.WeightedPartialProfits(individual_weights)
+            legacy_time, vectorized_time, identical, nb_cycles = 0.0, 0.0, True, 0
+
+            for _, task_avail, agent_avail, cycle_profits in source.cycles():
+                rows = table.rows(task_avail)
+                table.update_profits(rows, cycle_profits[rows] if cycle_profits is not None else None)
+                cycle_tasks = [source.tasks[x] for x in task_avail]
+                cycle_agents = [source.agents[x] for x in agent_avail]
+                index = function.CycleIndex.of(cycle_tasks, cycle_agents)
+
+                (legacy, legacy_weights), duration = timed(legacy_wpp_profits, cycle_tasks, cycle_agents,
+                                                           individual_weights, repeats=repeats)
+                legacy_time += duration
+                values, duration = timed(strategy.cycle_values, cycle_tasks, cycle_agents, repeats=repeats)
+                vectorized_time += duration
+                nb_cycles += 1
+
+                _, _, _, compat = index.matrices()
+                identical = (identical and strategy.mode() == np.mean(legacy_weights).round(decimals=3) and
+                             all(np.array_equal(a, b) for a, b in zip(legacy, function.split_values(compat, values))))
+
+                assigned_cols = np.where(compat.any(axis=1), index.cols[np.argmax(values, axis=1)], -1)
+                table.update(rows, assigned_cols)
+
+            print('%s;%s;%d;%.4f;%.4f;%.1f;%s' % (os.path.basename(f), strategy, nb_cycles, legacy_time,
+                                                  vectorized_time, legacy_time / vectorized_time, identical))
+
+
+def bench_dp(files, repeats):
+    """
+    Solves every cycle of the instances with the profits as values, by the dynamic programming fast path (falling back
+    to mulknap), by mulknap and by the MILP. Objectives are compared to the MILP, those of the fast path on the cycles
+    it solved itself. Defaults to the subset-sum instances, where mulknap applies.
+    """
+    from problem import DynamicProgramming, MaxAssignmentMilp, MultipleKnapsack
+
+    print('instance;cycles;dp_cycles;dp_s;mulknap_s;milp_s;mulknap_speedup;milp_speedup;dp_identical;'
+          'mulknap_identical')
+
+    for f in files:
+        source = function.CycleSource(f, cache=True)
+        table = source.table
+        dp = DynamicProgramming(MultipleKnapsack())
+        knapsack = MultipleKnapsack()
+        milp = MaxAssignmentMilp()
+        dp_time, knapsack_time, milp_time, nb_cycles = 0.0, 0.0, 0.0, 0
+        dp_identical, knapsack_identical = True, True
+
+        for _, task_avail, agent_avail, cycle_profits in source.cycles():
+            rows = table.rows(task_avail)
+            table.update_profits(rows, cycle_profits[rows] if cycle_profits is not None else None)
+            cycle_tasks = [source.tasks[x] for x in task_avail]
+            cycle_agents = [source.agents[x] for x in agent_avail]
+            profits, _, _, _ = function.CycleIndex.of(cycle_tasks, cycle_agents).matrices()
+
+            nb_solved = dp.nb_solved
+
+            # The solvers log each cycle
+            with contextlib.redirect_stdout(io.StringIO()):
+                (dp_objective, _, _), duration = timed(dp.optimize, cycle_tasks, cycle_agents, profits, '/tmp',
+                                                       repeats=repeats)
+                dp_time += duration
+                (knapsack_objective, _, _), duration = timed(knapsack.optimize, cycle_tasks, cycle_agents, profits,
+                                                             '/tmp', repeats=repeats)
+                knapsack_time += duration
+                (milp_objective, _, _), duration = timed(milp.optimize, cycle_tasks, cycle_agents, profits, '/tmp',
+                                                         repeats=repeats)
+                milp_time += duration
+
+            dp_identical = dp_identical and (dp.nb_solved == nb_solved or dp_objective == milp_objective)
+            knapsack_identical = knapsack_identical and knapsack_objective == milp_objective
+            nb_cycles += 1
+
+        print('%s;%d;%d;%.4f;%.4f;%.4f;%.1f;%.1f;%s;%s' % (os.path.basename(f), nb_cycles, dp.nb_solved // repeats,
+                                                           dp_time, knapsack_time, milp_time, knapsack_time / dp_time,
+                                                           milp_time / dp_time, dp_identical, knapsack_identical))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=['parse', 'wpp', 'dp'])
+    parser.add_argument('files', nargs='*', help='Instances, defaults to instances/*.pl (instances/*_su_*.pl for dp)')
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    args = parser.parse_intermixed_args()
+
+    pattern = '*_su_*.pl' if args.benchmark == 'dp' else '*.pl'
+    files = args.files if args.files else sorted(glob.glob(os.path.join('instances', pattern)))
+
+    if args.benchmark == 'parse':
+        bench_parse(files, args.repeats)
+    elif args.benchmark == 'wpp':
+        bench_wpp(files, args.repeats)
+    elif args.benchmark == 'dp':
+        bench_dp(files, args.repeats)
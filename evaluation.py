@@ -164,7 +164,7 @@ def identify_ignored_tasks(no_tasks, outfiles):
 
     for of in sorted(outfiles):
         cycleid = int(of.rsplit('_', 2)[-2])
-        _, _, _, _, assignments = function.load_instance(of)
+        _, _, _, _, assignments = function.load_instance(of, cache=False)
 
         for assigned in assignments.values():
             for taskid in assigned:
@@ -0,0 +1,39 @@
+"""
+Exchange selection of `SolverNegotiation`: a multi-dimensional knapsack over exchanges, where at most one exchange
+per group (task) is selected and weights may be negative (an exchange frees capacity at its source agent).
+Solved in-process as MIP by HiGHS, the models of a cycle have at most a few hundred items and solve in milliseconds.
+"""
+
+import time
+
+import numpy as np
+from scipy import sparse
+from scipy.optimize import Bounds, LinearConstraint, milp
+
+__all__ = ['solve']
+
+
+def solve(values, weights, capacities, groups, timeout=1):
+    """
+    Maximizes `values @ x` s.t. `weights @ x <= capacities` and at most one selected item per group, x binary.
+    `weights` is a constraints x items matrix, `capacities` are non-negative, so that selecting nothing is feasible.
+    Returns the objective, the selected items as boolean mask, the duration and whether the optimum was proven.
+    """
+    start = time.time()
+    values = np.asarray(values, dtype=int)
+    weights = np.asarray(weights, dtype=int).reshape((-1, len(values)))
+    _, group_rows = np.unique(np.asarray(groups), return_inverse=True)
+    nb_groups = group_rows.max() + 1 if len(values) > 0 else 0
+
+    group_constraints = sparse.csr_array((np.ones(len(values)), (group_rows, np.arange(len(values)))),
+                                        shape=(nb_groups, len(values)))
+    constraints = [LinearConstraint(weights, ub=np.asarray(capacities)),
+                   LinearConstraint(group_constraints, ub=np.ones(nb_groups))]
+
+    result = milp(-values, constraints=constraints, integrality=np.ones(len(values)), bounds=Bounds(0, 1),
+                  options={'time_limit': timeout})
+
+    # Without a feasible solution in time, no item is selected
+    selected = result.x > 0.5 if result.x is not None else np.zeros(len(values), dtype=bool)
+
+    return int(values[selected].sum()), selected, time.time() - start, result.status == 0
@@ -1,8 +1,12 @@
-import json
-import re
+import itertools
+import os
+import sys
 from collections import OrderedDict
+from collections.abc import Mapping
 import numpy as np
 
+import instance_cache
+
 
 def missed_assignments(tasks, agents=None):
     return [t.missed_assignments(agents) for t in tasks]
@@ -12,12 +16,33 @@ def max_task_pressures(tasks, agents=None):
     return [max(t.relative_affinities(agents)) for t in tasks]
 
 
+def _common_table(tasks):
+    """ The table of `tasks` with their rows, if all tasks are views on the same table """
+    tables = set(id(t.table) for t in tasks)
+
+    if len(tables) != 1:
+        return None, None
+
+    return tasks[0].table, np.array([t.row for t in tasks], dtype=int)
+
+
 def task_pressures(tasks, agents=None):
-    return [t.pressure(agents) for t in tasks]
+    tasks = list(tasks)
+    table, rows = _common_table(tasks)
+
+    if table is None:
+        return np.array([t.pressure(agents) for t in tasks])
+
+    cols = None
+
+    if agents:
+        cols = [table.agent_cols[a.name] for a in agents if a.name in table.agent_cols]
+
+    return table.pressures(rows, cols)
 
 
 def affinity_pressure(tasks, agents=None):
-    return max(task_pressures(tasks, agents))
+    return np.max(task_pressures(tasks, agents))
 
 
 def affinity_pressure_mean(tasks, agents=None):
@@ -28,108 +53,744 @@ def affinity_pressure_percentile(tasks, agents=None, perc=95):
     return np.percentile(task_pressures(tasks, agents), q=perc)
 
 
-def load_instance(instance):
-    tasks = {}
-    agents = {}
-    task_avail = []
-    agent_avail = []
-    profits = []
-    assignments = {}
+def _decode_int_lists(bodies):
+    """ Decodes comma-separated integer lists in one pass, returns them as flat array + offsets """
+    lengths = [b.count(',') + 1 if b.strip() else 0 for b in bodies]
+    indptr = np.zeros(len(bodies) + 1, dtype=int)
+    np.cumsum(lengths, out=indptr[1:])
+    values = np.fromstring(','.join(b for b in bodies if b.strip()), dtype=int, sep=',')
+
+    assert (len(values) == indptr[-1])
+
+    return values, indptr
+
 
-    task_regex = re.compile(
-        r"task\((?P<name>\d+),(?P<weights>\[[\d,\s]+\]),(?P<profits>\[[\d,\s]+\]),(?P<poss_agents>\[[\d,\s]*\])\)")
-    agent_regex = re.compile(r"agent\((?P<name>\d+),(?P<capacity>\d+)\)")
-    assign_regex = re.compile(r"assignment\((?P<name>\d+),(?P<assigned_tasks>\[[\d,\s]*\])\)")
-    avail_regex = re.compile(r"(?P<type>(task|agent)avail)\((?P<cycle>\d+),(?P<availabilities>\[[\d,\s]*\])\)")
-    profit_regex = re.compile(r"profit\((?P<cycle>\d+),(?P<profits>[\d\s,\[\]]*)\).")
+def _name_positions(names, values):
+    """ Maps names to their position in `names` """
+    order = np.argsort(names, kind='stable')
+    pos = np.searchsorted(names, values, sorter=order)
+    pos = order[np.minimum(pos, len(names) - 1)]
 
-    for line in open(instance, 'r'):
-        line = line.replace(' ', '')
+    assert (np.all(names[pos] == values))
 
-        m = task_regex.match(line)
-        if m:
-            name = int(m.group('name'))
-            weights = json.loads(m.group('weights'))
-            poss_agents = json.loads(m.group('poss_agents'))
-            prios = json.loads(m.group('profits'))
+    return pos
 
-            assert (len(weights) == len(poss_agents))
-            assert (len(prios) == len(poss_agents))
-            assert (name not in tasks)
 
-            t = Task(name, weights, prios, poss_agents)
-            tasks[name] = t
+def _pack_availability(cycles, bodies, names):
+    nb_cycles = max(cycles) if cycles else 0
+    avail = np.zeros((nb_cycles, len(names)), dtype=bool)
+    values, indptr = _decode_int_lists(bodies)
 
-        m = agent_regex.match(line)
+    if len(values) > 0:
+        rows = np.repeat(np.asarray(cycles, dtype=int) - 1, np.diff(indptr))
+        avail[rows, _name_positions(names, values)] = True
 
-        if m:
-            name = int(m.group('name'))
-            capacity = int(m.group('capacity'))
+    return np.packbits(avail, axis=1)
 
-            assert (capacity > 0)
-            assert (name not in agents)
 
-            a = Agent(name, capacity)
-            agents[name] = a
+def _split_fact(line):
+    """ Splits a fact `name(body).` into its name and body """
+    fact, _, body = line.partition('(')
+    return fact.strip(), body[:body.rfind(')')]
 
-        m = avail_regex.match(line)
 
-        if m and m.group('type') == 'taskavail':
-            cycle = int(m.group('cycle'))
-            availabilities = json.loads(m.group('availabilities'))
-            task_avail.insert(cycle - 1, availabilities)
-        elif m and m.group('type') == 'agentavail':
-            cycle = int(m.group('cycle'))
-            availabilities = json.loads(m.group('availabilities'))
-            agent_avail.insert(cycle - 1, availabilities)
+def _static_arrays(agent_facts, task_facts):
+    agent_names = np.array([a[0] for a in agent_facts], dtype=int)
+    capacities = np.array([a[1] for a in agent_facts], dtype=int)
 
-        m = assign_regex.match(line)
+    assert (np.all(capacities > 0))
+    assert (len(np.unique(agent_names)) == len(agent_names))
 
-        if m:
-            agent = int(m.group('name'))
-            assigned_tasks = json.loads(m.group('assigned_tasks'))
-            assignments[agent] = assigned_tasks
+    task_names = np.array([t[0] for t in task_facts], dtype=int)
+    task_weights, weight_ptr = _decode_int_lists([t[1] for t in task_facts])
+    task_profits, profit_ptr = _decode_int_lists([t[2] for t in task_facts])
+    task_agents, task_indptr = _decode_int_lists([t[3] for t in task_facts])
 
-        m = profit_regex.match(line)
+    assert (np.array_equal(weight_ptr, task_indptr))
+    assert (np.array_equal(profit_ptr, task_indptr))
+    assert (len(np.unique(task_names)) == len(task_names))
 
-        if m:
-            cycle = int(m.group('cycle'))
-            prof = json.loads(m.group('profits'))
-            profits.append((cycle, prof))
+    return {
+        'agent_names': agent_names,
+        'capacities': capacities,
+        'task_names': task_names,
+        'task_indptr': task_indptr,
+        'task_agents': task_agents,
+        'task_weights': task_weights,
+        'task_profits': task_profits
+    }
 
-    if len(profits) > 0:
-        assert (len(profits) == len(task_avail) - 1)
 
-        for _, prof in sorted(profits, key=lambda x: x[0]):
-            for t, p in zip(tasks, prof):
-                tasks[t].future_profits.append(p)
+def _parse_static_fact(fact, body, agent_facts, task_facts):
+    if fact == 'task':
+        name, lists = body.split(',', 1)
+        weights, prios, poss_agents = (x.strip(' ,') for x in lists.replace('[', '').split(']')[:3])
+        task_facts.append((int(name), weights, prios, poss_agents))
+    elif fact == 'agent':
+        name, capacity = body.split(',')
+        agent_facts.append((int(name), int(capacity)))
+    else:
+        return False
+
+    return True
+
+
+def parse_instance(instance):
+    """
+    Reads an instance file in one pass and decodes all facts into NumPy arrays.
+    Tasks are stored in CSR form (`task_indptr` into `task_agents`, `task_weights`, `task_profits`),
+    availabilities as bit-packed cycles x tasks/agents matrices (bit i: i-th task/agent in file order).
+    """
+    agent_facts = []
+    task_facts = []
+    avail_facts = {'taskavail': ([], []), 'agentavail': ([], [])}
+    profit_facts = []
+    assign_facts = []
+
+    with open(instance, 'r') as f:
+        for line in f:
+            fact, body = _split_fact(line)
+
+            if _parse_static_fact(fact, body, agent_facts, task_facts):
+                continue
+            elif fact in avail_facts:
+                cycle, _, availabilities = body.partition(',')
+                avail_facts[fact][0].append(int(cycle))
+                avail_facts[fact][1].append(availabilities.strip(' []'))
+            elif fact == 'profit':
+                cycle, _, prof = body.partition(',')
+                profit_facts.append((int(cycle), prof.strip(' []')))
+            elif fact == 'assignment':
+                name, _, assigned_tasks = body.partition(',')
+                assign_facts.append((int(name), assigned_tasks.strip(' []')))
+
+    data = _static_arrays(agent_facts, task_facts)
+
+    task_avail = _pack_availability(*avail_facts['taskavail'], names=data['task_names'])
+    agent_avail = _pack_availability(*avail_facts['agentavail'], names=data['agent_names'])
 
     assert (len(task_avail) == len(agent_avail))
-    assert (all(len(x) <= len(tasks) for x in task_avail))
-    assert (all(len(x) <= len(agents) for x in agent_avail))
+
+    profit_facts.sort(key=lambda x: x[0])
+    profit_cycles = np.array([p[0] for p in profit_facts], dtype=int)
+    future_profits, _ = _decode_int_lists([p[1] for p in profit_facts])
+    future_profits = future_profits.reshape((len(profit_facts), len(data['task_names'])))
+
+    if len(profit_facts) > 0:
+        assert (len(profit_facts) == len(task_avail) - 1)
+
+    assign_agents = np.array([a[0] for a in assign_facts], dtype=int)
+    assign_tasks, assign_indptr = _decode_int_lists([a[1] for a in assign_facts])
+
+    data.update({
+        'task_avail': task_avail,
+        'agent_avail': agent_avail,
+        'profit_cycles': profit_cycles,
+        'future_profits': future_profits,
+        'assign_agents': assign_agents,
+        'assign_indptr': assign_indptr,
+        'assign_tasks': assign_tasks
+    })
+
+    return data
+
+
+def unpack_availability(packed, names):
+    """ Returns the names set in each cycle row of a bit-packed availability matrix """
+    avail = np.unpackbits(packed, axis=1, count=len(names)).astype(bool)
+    return [names[row].tolist() for row in avail]
+
+
+def build_agents(data):
+    return {name: Agent(name, capacity) for name, capacity in zip(data['agent_names'].tolist(),
+                                                                  data['capacities'].tolist())}
+
+
+def build_tasks_and_agents(data, future_profits=True):
+    return TaskTable.from_data(data, future_profits).tasks(), build_agents(data)
+
+
+def build_instance(data):
+    tasks, agents = build_tasks_and_agents(data)
+
+    task_avail = unpack_availability(data['task_avail'], data['task_names'])
+    agent_avail = unpack_availability(data['agent_avail'], data['agent_names'])
+
+    assign_indptr = data['assign_indptr'].tolist()
+    assign_tasks = data['assign_tasks'].tolist()
+    assignments = {}
+
+    for i, agent in enumerate(data['assign_agents'].tolist()):
+        assignments[agent] = assign_tasks[assign_indptr[i]:assign_indptr[i + 1]]
 
     return tasks, agents, task_avail, agent_avail, assignments
 
 
+def load_instance_data(instance, cache=True):
+    """ Instance arrays from a binary instance or a `.pl` file, the latter through its sidecar cache """
+    if instance.endswith(instance_cache.SUFFIX):
+        return instance_cache.read(instance)
+    elif cache:
+        return instance_cache.load(instance, parse_instance)
+    else:
+        return parse_instance(instance)
+
+
+def load_instance(instance, cache=True):
+    return build_instance(load_instance_data(instance, cache))
+
+
+class CycleSource(object):
+    """
+    Tasks and agents of an instance, whose cycles (availabilities and profits) are read lazily.
+
+    `instance` is a file or '-' for stdin. With `history_size`, only the assignments of the last
+    `history_size` cycles are kept. Files are read through the instance cache and each cycle is
+    unpacked once it is reached. On stdin, all task and agent facts come first, followed by the cycle facts
+    grouped by cycle. A cycle starts once its task and agent availabilities are known and either its profits,
+    a fact of a later cycle or the end of input arrived.
+    """
+    CYCLE_FACTS = ('taskavail', 'agentavail', 'profit')
+
+    def __init__(self, instance, cache=True, history_size=None):
+        if instance == '-':
+            self.name = 'stdin'
+            self._facts = (_split_fact(line) for line in sys.stdin if line.strip())
+            self._data = self._read_static_facts()
+        else:
+            basename = os.path.basename(instance)
+
+            if basename.endswith(instance_cache.SUFFIX):
+                basename = basename[:-len(instance_cache.SUFFIX)]
+
+            self.name = os.path.splitext(basename)[0]
+            self._facts = None
+            self._data = load_instance_data(instance, cache)
+
+        self.table = TaskTable.from_data(self._data, future_profits=False)
+        self.tasks = self.table.tasks()
+
+        if history_size:
+            self.table.reserve_history(history_size, ring=True)
+        elif self._facts is None and len(self._data['task_avail']) > 0:
+            self.table.reserve_history(len(self._data['task_avail']))
+        self.agents = build_agents(self._data)
+
+    def _read_static_facts(self):
+        agent_facts = []
+        task_facts = []
+
+        for fact, body in self._facts:
+            if not _parse_static_fact(fact, body, agent_facts, task_facts):
+                self._facts = itertools.chain([(fact, body)], self._facts)
+                break
+
+        return _static_arrays(agent_facts, task_facts)
+
+    def cycle_costs(self):
+        """ Size (available tasks x available agents) of each cycle, None if the cycles are streamed """
+        if self._facts is not None:
+            return None
+
+        data = self._data
+        nb_tasks = np.unpackbits(data['task_avail'], axis=1, count=len(data['task_names'])).sum(axis=1)
+        nb_agents = np.unpackbits(data['agent_avail'], axis=1, count=len(data['agent_names'])).sum(axis=1)
+
+        return nb_tasks.astype(int) * nb_agents
+
+    def cycles(self):
+        """ Yields (cycle, available task names, available agent names, profits of all tasks in table order or None) """
+        if self._facts is None:
+            return self._stored_cycles()
+        else:
+            return self._streamed_cycles()
+
+    def _stored_cycles(self):
+        data = self._data
+        profit_rows = {c: i for i, c in enumerate(data['profit_cycles'].tolist())}
+
+        for i in range(len(data['task_avail'])):
+            cycle = i + 1
+            task_avail = unpack_availability(data['task_avail'][i:i + 1], data['task_names'])[0]
+            agent_avail = unpack_availability(data['agent_avail'][i:i + 1], data['agent_names'])[0]
+            profits = None
+
+            if cycle in profit_rows:
+                profits = np.asarray(data['future_profits'][profit_rows[cycle]])
+
+            yield cycle, task_avail, agent_avail, profits
+
+    def _streamed_cycles(self):
+        pending = {}
+        next_cycle = 1
+        last_cycle = 0
+
+        def startable(cycle):
+            facts = pending.get(cycle, {})
+            return ('taskavail' in facts and 'agentavail' in facts and
+                    (cycle == 1 or 'profit' in facts or last_cycle > cycle))
+
+        for fact, body in self._facts:
+            if fact not in self.CYCLE_FACTS:
+                raise ValueError('Unexpected fact %s after the first cycle fact' % fact)
+
+            cycle, _, values = body.partition(',')
+            cycle = int(cycle)
+
+            if cycle < next_cycle:
+                raise ValueError('%s(%d) arrived after cycle %d started' % (fact, cycle, next_cycle - 1))
+
+            values, _ = _decode_int_lists([values.strip(' []')])
+            pending.setdefault(cycle, {})[fact] = values
+            last_cycle = max(last_cycle, cycle)
+
+            while startable(next_cycle):
+                yield self._streamed_cycle(next_cycle, pending.pop(next_cycle))
+                next_cycle += 1
+
+        while pending:
+            assert (next_cycle in pending)
+
+            facts = pending.pop(next_cycle)
+            assert ('taskavail' in facts and 'agentavail' in facts)
+            yield self._streamed_cycle(next_cycle, facts)
+            next_cycle += 1
+
+    def _streamed_cycle(self, cycle, facts):
+        assert (len(facts['taskavail']) <= len(self.tasks))
+        assert (len(facts['agentavail']) <= len(self.agents))
+
+        profits = facts.get('profit')
+
+        return cycle, facts['taskavail'].tolist(), facts['agentavail'].tolist(), profits
+
+
 def all_assignable(tasks, agents):
-    agent_names = [a.name for a in agents]
+    return CycleIndex.of(tasks, agents).all_assignable()
 
-    for t in tasks:
-        if not any((k for k in t.profits.keys() if k in agent_names)):
-            return False
 
-    return True
+class TaskTable(object):
+    """
+    Weights, profits and affinities of all tasks of an instance as dense tasks x agents matrices.
+    Rows follow the order of `task_names`, columns the order of `agent_names`. `compat` marks the possible
+    agents of a task, all other entries are 0. Tasks are accessed through `Task` views on a row.
+    """
+
+    def __init__(self, task_names, agent_names, indptr, cols, weights, profits, future_profits=None):
+        self.task_names = [int(x) for x in task_names]
+        self.agent_names = [int(x) for x in agent_names]
+        self.task_rows = {name: i for i, name in enumerate(self.task_names)}
+        self.agent_cols = {name: i for i, name in enumerate(self.agent_names)}
+
+        indptr = np.asarray(indptr, dtype=int)
+        cols = np.asarray(cols, dtype=int)
+        shape = (len(self.task_names), len(self.agent_names))
+        rows = np.repeat(np.arange(shape[0]), np.diff(indptr))
+
+        self.compat = np.zeros(shape, dtype=bool)
+        self.compat[rows, cols] = True
+        self.weights = np.zeros(shape, dtype=int)
+        self.weights[rows, cols] = weights
+        self.profits = np.zeros(shape, dtype=int)
+        self.profits[rows, cols] = profits
+        self.restricted = np.zeros(shape, dtype=bool)
+
+        # Affinities are derived from the number of cycles a task took part in and the cycle it
+        # was last assigned to each agent, so that an update only touches the assigned pairs
+        self.cycles_seen = np.zeros(shape[0], dtype=int)
+        self.last_assigned = np.full(shape, -1, dtype=int)
+
+        # Kept up to date for the affinity sums and pressures over all agents
+        self.nb_compatible = self.compat.sum(axis=1)
+        self.last_assigned_sum = -self.nb_compatible
+
+        # Possible agents of each task, in the order of the task definition
+        self.task_cols = np.split(cols, indptr[1:-1]) if shape[0] > 0 else []
+
+        if future_profits is None:
+            future_profits = np.zeros((0, shape[0]), dtype=int)
+
+        self.future_profits = np.asarray(future_profits, dtype=int)
+        self.future_left = np.full(shape[0], len(self.future_profits))
+
+        # Assignment history, one row per recorded cycle: -1 unavailable, 0 unassigned, else column + 1
+        self.history = np.empty((0, shape[0]), dtype=np.int16 if shape[1] < 2 ** 15 else np.int32)
+        self.history_cycles = 0
+        self.history_ring = False
+        self.assignment_counts = np.zeros(shape[0], dtype=int)
+
+        self.submatrix_cache_size = 32
+        self._submatrices = OrderedDict()
+        self.cycle_index = None
+
+    @classmethod
+    def from_data(cls, data, future_profits=True):
+        agent_names = data['agent_names']
+        undefined = np.setdiff1d(data['task_agents'], agent_names)
+
+        if len(undefined) > 0:
+            agent_names = np.concatenate((agent_names, undefined))
+
+        cols = _name_positions(agent_names, data['task_agents'])
+
+        return cls(data['task_names'], agent_names, data['task_indptr'], cols,
+                   data['task_weights'], data['task_profits'],
+                   data['future_profits'] if future_profits else None)
+
+    @property
+    def affinities(self):
+        """ Cycles since the last assignment of each task to each compatible agent (1: assigned in the last cycle) """
+        return (self.cycles_seen[:, np.newaxis] - self.last_assigned) * self.compat
+
+    def affinity(self, rows, cols):
+        return (self.cycles_seen[rows] - self.last_assigned[rows, cols]) * self.compat[rows, cols]
+
+    def affinity_sums(self, rows=None, cols=None):
+        """ Sum and number of the affinities of `rows` (default: all tasks) towards the agents `cols` (default: all) """
+        rows = slice(None) if rows is None else np.asarray(rows, dtype=int)
+
+        if cols is None:
+            counts = self.nb_compatible[rows]
+            sums = counts * self.cycles_seen[rows] - self.last_assigned_sum[rows]
+        else:
+            cols = np.asarray(cols, dtype=int)
+            compat = self.compat[rows][:, cols]
+            affs = (self.cycles_seen[rows, np.newaxis] - self.last_assigned[rows][:, cols]) * compat
+            sums = affs.sum(axis=1)
+            counts = compat.sum(axis=1)
+
+        return sums, counts
+
+    def pressures(self, rows=None, cols=None):
+        """ Affinity pressure of each task: mean excess of its affinities over the ideal rotation 1, ..., C """
+        sums, counts = self.affinity_sums(rows, cols)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (sums - counts * (counts + 1) / 2) / counts
+
+    def agent_submatrices(self, cols):
+        """
+        Weights and compatibility of all tasks towards the agents `cols`. Both never change, so they are
+        kept in a LRU cache per agent selection, which repeats often between cycles.
+        """
+        key = tuple(cols.tolist() if isinstance(cols, np.ndarray) else cols)
+
+        if key in self._submatrices:
+            self._submatrices.move_to_end(key)
+        else:
+            cols = np.asarray(key, dtype=int)
+            self._submatrices[key] = (self.weights[:, cols], self.compat[:, cols])
+
+            if len(self._submatrices) > self.submatrix_cache_size:
+                self._submatrices.popitem(last=False)
+
+        return self._submatrices[key]
+
+    def cycle_matrices(self, rows, cols):
+        """
+        Profit, affinity, weight and compatibility matrices of the tasks `rows` towards the agents `cols`.
+        Restricted agents count as incompatible, all values of incompatible pairs are 0.
+        """
+        rows = np.asarray(rows, dtype=int)
+        cols = np.asarray(cols, dtype=int)
+        weights, compat = self.agent_submatrices(cols)
+        idx = np.ix_(rows, cols)
+
+        compat = compat[rows] & ~self.restricted[idx]
+        weights = weights[rows] * compat
+        profits = self.profits[idx] * compat
+        affs = (self.cycles_seen[rows, np.newaxis] - self.last_assigned[idx]) * compat
+
+        return profits, affs, weights, compat
+
+    def agent_mask(self, agents):
+        """ Boolean mask over all agent columns, set for `agents` """
+        index = self.cycle_index
+
+        if index is not None and agents is index.agents:
+            return index.agent_mask
+
+        mask = np.zeros(len(self.agent_names), dtype=bool)
+        mask[[self.agent_cols[a.name] for a in agents if a.name in self.agent_cols]] = True
+
+        return mask
+
+    def tasks(self):
+        return {name: Task.view(self, row) for row, name in enumerate(self.task_names)}
+
+    def rows(self, task_names):
+        return np.array([self.task_rows[x] for x in task_names], dtype=int)
+
+    def cols(self, agent_names):
+        return np.array([self.agent_cols[x] for x in agent_names], dtype=int)
+
+    def update_profits(self, rows, prios=None):
+        """
+        Emulates test case prioritization: Sets the profits of all possible agents of `rows` to their new priority,
+        by default the next of their future profits, and lifts restrictions.
+        """
+        rows = np.asarray(rows, dtype=int)
+        self.restricted[rows] = False
+
+        if prios is None:
+            rows = rows[self.future_left[rows] > 0]
+            self.future_left[rows] -= 1
+            prios = self.future_profits[self.future_left[rows], rows]
+
+        self.profits[rows] = self.compat[rows] * np.asarray(prios, dtype=int)[:, np.newaxis]
+
+    def restrict(self, rows, cols):
+        """ Hides the agents `cols` from the possible agents of `rows` until the next profit update """
+        self.restricted[rows, cols] = True
+
+    def update(self, rows, assigned_cols, cols=None):
+        """
+        Ages the affinities of `rows` towards all compatible agents (or only those in `cols`) by one cycle
+        and resets them to 1 for the assigned agents. `assigned_cols` holds -1 for unassigned tasks.
+        Each update is recorded as one cycle of the history.
+        """
+        rows = np.asarray(rows, dtype=int)
+        assigned_cols = np.asarray(assigned_cols, dtype=int)
+        self.record(rows, assigned_cols)
+
+        self.cycles_seen[rows] += 1
+
+        if cols is not None:
+            # Keep the affinities towards all other agents
+            excluded = np.ones(len(self.agent_names), dtype=bool)
+            excluded[np.asarray(cols, dtype=int)] = False
+            self.last_assigned[np.ix_(rows, np.flatnonzero(excluded))] += 1
+            self.last_assigned_sum[rows] += self.compat[rows][:, excluded].sum(axis=1)
+
+        assigned = assigned_cols >= 0
+        rows, assigned_cols = rows[assigned], assigned_cols[assigned]
+        last_assigned = self.cycles_seen[rows] - 1
+        self.last_assigned_sum[rows] += last_assigned - self.last_assigned[rows, assigned_cols]
+        self.last_assigned[rows, assigned_cols] = last_assigned
+        self.assignment_counts[rows] += 1
+
+    def reserve_history(self, cycles, ring=False):
+        """
+        Preallocates the history for `cycles` cycles, it grows beyond that as needed.
+        In ring mode, only the last `cycles` cycles are kept instead.
+        """
+        assert (cycles > 0)
+
+        history = self.cycle_history()[-cycles:]
+        self.history = np.full((cycles, len(self.task_names)), -1, dtype=self.history.dtype)
+        self.history[:len(history)] = history
+        self.history_cycles = len(history)
+        self.history_ring = ring
+
+    def record(self, rows, assigned_cols):
+        """ Appends one cycle to the history: `rows` were available, `assigned_cols` holds -1 for unassigned tasks """
+        if self.history_ring:
+            i = self.history_cycles % len(self.history)
+        else:
+            i = self.history_cycles
+
+            if i == len(self.history):
+                grown = np.full((max(2 * i, 16), len(self.task_names)), -1, dtype=self.history.dtype)
+                grown[:i] = self.history
+                self.history = grown
+
+        self.history[i] = -1
+        self.history[i, rows] = np.asarray(assigned_cols) + 1
+        self.history_cycles += 1
+
+    def cycle_history(self):
+        """ Recorded cycles x tasks history in chronological order, only the kept cycles in ring mode """
+        if self.history_ring and self.history_cycles > len(self.history):
+            return np.roll(self.history, -(self.history_cycles % len(self.history)), axis=0)
+
+        return self.history[:self.history_cycles]
+
+    def last_cycle(self):
+        """ History of the last recorded cycle as agent names, 0 for unassigned and -1 for unavailable tasks """
+        assert (self.history_cycles > 0)
+
+        names = np.concatenate(([-1, 0], self.agent_names))
+        return names[self.cycle_history()[-1] + 1]
+
+
+class CycleIndex(object):
+    """
+    Availability of one cycle, built once when the cycle starts: rows of the available tasks, columns and
+    mask of the available agents, and which available agents each task is compatible with.
+    Restrictions can change during a cycle and are applied on every access.
+    """
+
+    def __init__(self, table, rows, cols, agents=None):
+        self.table = table
+        self.rows = rows
+        self.cols = cols
+        self.agents = agents
+
+        self.agent_mask = np.zeros(len(table.agent_names), dtype=bool)
+        self.agent_mask[cols] = True
+
+        _, compat = table.agent_submatrices(cols)
+        self.compat = compat[rows]
+
+    @classmethod
+    def of(cls, tasks, agents):
+        """ The index of the cycle `tasks` x `agents`, reused as long as the cycle stays the same """
+        tasks = list(tasks)
+        table, rows = _common_table(tasks)
+
+        assert (table is not None)
+
+        if not isinstance(agents, list):
+            agents = list(agents)
+
+        cols = table.cols(a.name for a in agents)
+        index = table.cycle_index
+
+        if index is None or not (np.array_equal(index.rows, rows) and np.array_equal(index.cols, cols)):
+            index = cls(table, rows, cols, agents)
+            table.cycle_index = index
+        else:
+            index.agents = agents
+
+        return index
+
+    def available(self):
+        """ Compatible, unrestricted agents of each task """
+        return self.compat & ~self.table.restricted[np.ix_(self.rows, self.cols)]
+
+    def all_assignable(self):
+        return bool(np.all(self.available().any(axis=1)))
+
+    def restrict(self, mask):
+        """ Hides the agents set in the tasks x agents `mask` of this cycle until the next profit update """
+        self.table.restricted[np.ix_(self.rows, self.cols)] |= mask
+
+    def matrices(self):
+        return self.table.cycle_matrices(self.rows, self.cols)
+
+    def previous_assignment(self):
+        """
+        Assignment vector of the last recorded cycle, mapped onto this cycle: tasks keep their agent if it is
+        available to them in this cycle, all other tasks are unassigned
+        """
+        assignment = np.zeros(len(self.rows), dtype=int)
+
+        if self.table.history_cycles == 0:
+            return assignment
+
+        previous_cols = self.table.cycle_history()[-1][self.rows].astype(int) - 1
+        positions = np.full(len(self.table.agent_names), -1)
+        positions[self.cols] = np.arange(len(self.cols))
+
+        kept = np.flatnonzero(previous_cols >= 0)
+        kept_positions = positions[previous_cols[kept]]
+        available = kept_positions >= 0
+        kept, kept_positions = kept[available], kept_positions[available]
+        available = self.available()[kept, kept_positions]
+
+        assignment[kept[available]] = kept_positions[available] + 1
+        return assignment
+
+    def task_values(self):
+        """ Profits and affinities of each task towards its available agents, as one array per task """
+        profits, affs, _, available = self.matrices()
+        return split_values(available, profits), split_values(available, affs)
+
+
+def dense_values(compat, values):
+    """ Scatters the values of each task, given for its compatible agents, into a dense tasks x agents matrix """
+    values = np.concatenate(values) if len(values) > 0 else np.zeros(0, dtype=int)
+    dense = np.zeros(compat.shape, dtype=values.dtype)
+    dense[compat] = values
+
+    return dense
+
+
+def split_values(compat, values):
+    """ Values of each task towards its compatible agents from a dense tasks x agents matrix, one array per task """
+    return np.split(values[compat], np.cumsum(compat.sum(axis=1))[:-1])
+
+
+def is_dense(values):
+    return isinstance(values, np.ndarray) and values.ndim == 2
+
+
+class _AgentValues(Mapping):
+    """ Read-only view on a task row of TaskTable values, keyed by agent name. `values(row, cols)` reads them. """
+
+    def __init__(self, table, row, values, hidden=None):
+        self._table = table
+        self._row = row
+        self._values = values
+        self._hidden = hidden
+
+    def _cols(self):
+        cols = self._table.task_cols[self._row]
+
+        if self._hidden is not None:
+            cols = cols[~self._hidden[self._row, cols]]
+
+        return cols
+
+    def __getitem__(self, agent_name):
+        col = self._table.agent_cols.get(agent_name)
+
+        if col is None or not self._table.compat[self._row, col] or (
+                self._hidden is not None and self._hidden[self._row, col]):
+            raise KeyError(agent_name)
+
+        return int(self._values(self._row, col))
+
+    def __iter__(self):
+        names = self._table.agent_names
+        return (names[c] for c in self._cols().tolist())
+
+    def __len__(self):
+        return len(self._cols())
+
+    def values(self):
+        return self._values(self._row, self._cols()).tolist()
+
+
+def _matrix_values(matrix):
+    return lambda rows, cols: matrix[rows, cols]
 
 
 class Task(object):
-    def __init__(self, name, weights, profits, poss_agents, future_profits=[]):
-        self.name = name
-        self.weights = OrderedDict(zip(poss_agents, weights))
-        self.profits = OrderedDict(zip(poss_agents, profits))
-        self.affinities = OrderedDict([(name, 1) for name in poss_agents])
-        self.future_profits = future_profits
-        self.history = []
-        self.backup_profits = None
+    def __init__(self, name, weights, profits, poss_agents, future_profits=None):
+        poss_agents = list(poss_agents)
+        fp = np.array([future_profits], dtype=int).T if future_profits else None
+        table = TaskTable([name], poss_agents, [0, len(poss_agents)], np.arange(len(poss_agents)),
+                          weights, profits, fp)
+        self._bind(table, 0)
+
+    @classmethod
+    def view(cls, table, row):
+        t = cls.__new__(cls)
+        t._bind(table, row)
+        return t
+
+    def __reduce__(self):
+        # Pickled as view, the table is shared by all tasks pickled together
+        return Task.view, (self.table, self.row)
+
+    def _bind(self, table, row):
+        self.table = table
+        self.row = row
+        self.name = table.task_names[row]
+        self.weights = _AgentValues(table, row, _matrix_values(table.weights))
+        self.profits = _AgentValues(table, row, _matrix_values(table.profits), hidden=table.restricted)
+        self.affinities = _AgentValues(table, row, table.affinity)
+
+    @property
+    def future_profits(self):
+        return self.table.future_profits[:self.table.future_left[self.row], self.row].tolist()
+
+    @property
+    def history(self):
+        """ Names of the agents the task was assigned to, only of the kept cycles in ring mode """
+        cols = self.table.cycle_history()[:, self.row]
+        return [self.table.agent_names[c - 1] for c in cols[cols > 0].tolist()]
 
     def relative_affinities(self, agents=None):
         affs = self._filtered_affinities(agents)
@@ -139,8 +800,8 @@ class Task(object):
     def pressure(self, agents=None):
         affs = self._filtered_affinities(agents)
         C = len(affs)
-        actual = self.affinity_sum(agents)
-        ideal = self.ideal_affinity_sum(agents)
+        actual = affs.sum()
+        ideal = C * (C + 1) / 2
         return (actual - ideal) / C
 
     def affinity_sum(self, agents=None):
@@ -151,11 +812,12 @@ class Task(object):
         return C * (C + 1) / 2
 
     def _filtered_affinities(self, agents=None):
+        cols = self.table.task_cols[self.row]
+
         if agents:
-            agent_names = [a.name for a in agents]
-            affs = np.array([v for k, v in self.affinities.items() if k in agent_names])
-        else:
-            affs = np.array(list(self.affinities.values()))
+            cols = cols[self.table.agent_mask(agents)[cols]]
+
+        affs = self.table.affinity(self.row, cols)
 
         # Scale affinities by their min., to give higher importance to completely unassigned tasks
         # Skipped, because experiments showed no benefit from this
@@ -172,33 +834,16 @@ class Task(object):
         if isinstance(agents, dict):
             agents = agents.values()
 
-        for ag in agents:
-            if ag.name in self.affinities:
-                self.affinities[ag.name] += 1
-
-        if assigned_agent:
-            self.affinities[assigned_agent.name] = 1
-            self.history.append(assigned_agent.name)
-
-    def update_profit(self):
-        """ Emulates test case prioritization """
-        if self.backup_profits is not None:
-            self.profits = OrderedDict(self.backup_profits)
-            self.backup_profits = None
+        cols = [self.table.agent_cols[ag.name] for ag in agents if ag.name in self.table.agent_cols]
+        assigned_col = self.table.agent_cols[assigned_agent.name] if assigned_agent else -1
+        self.table.update([self.row], [assigned_col], cols)
 
-        if len(self.future_profits) == 0:
-            return
-
-        poss_agents = self.profits.keys()
-        next_prio = self.future_profits.pop()
-        prio_dict = [(pa, next_prio) for pa in poss_agents]
-        self.profits = OrderedDict(prio_dict)
+    def update_profit(self, next_prio=None):
+        """ Emulates test case prioritization, uses the next of the future profits if no profit is given """
+        self.table.update_profits([self.row], None if next_prio is None else [next_prio])
 
     def restrict_agent(self, agent_name):
-        if self.backup_profits is None:
-            self.backup_profits = OrderedDict(self.profits)
-
-        del self.profits[agent_name]
+        self.table.restrict(self.row, self.table.agent_cols[agent_name])
 
     @property
     def poss_agents(self):
@@ -225,7 +870,145 @@ class Agent(object):
         return self.name
 
 
+def cycle_matrices(agents, tasks):
+    """ Profit, affinity, weight and compatibility matrices of `tasks` x `agents` """
+    tasks = list(tasks)
+    table, _ = _common_table(tasks)
+
+    if table is None:
+        prof_mat, aff_mat, weight_mat = _task_matrizes(agents, tasks)
+        compat = np.array([[a.name in t.poss_agents for a in agents] for t in tasks], dtype=bool)
+        return prof_mat, aff_mat, weight_mat, compat.reshape(weight_mat.shape)
+
+    return CycleIndex.of(tasks, agents).matrices()
+
+
+def subcycle(agents, tasks, task_positions, agent_positions, available=None, capacities=None):
+    """
+    Tasks and agents at the given positions of the cycle, with the tasks as views on an own compact table.
+    Possible agents are the available agents in the cycle, further limited by the cycle's tasks x agents mask
+    `available`. The agents keep their capacities unless `capacities` are given. The previous assignment of the
+    tasks is recorded as the history of the new table. Cheap to send to other processes.
+    """
+    tasks = list(tasks)
+    profits, _, weights, compat = cycle_matrices(agents, tasks)
+    compat = compat if available is None else compat & available
+    idx = np.ix_(task_positions, agent_positions)
+    compat = compat[idx]
+    rows, cols = np.nonzero(compat)
+
+    if capacities is None:
+        sub_agents = [agents[i] for i in agent_positions]
+    else:
+        sub_agents = [Agent(agents[i].name, capacity) for i, capacity in zip(agent_positions, capacities)]
+
+    table = TaskTable([tasks[i].name for i in task_positions], [a.name for a in sub_agents],
+                      np.concatenate(([0], np.cumsum(compat.sum(axis=1)))), cols,
+                      weights[idx][rows, cols], profits[idx][rows, cols])
+
+    parent, _ = _common_table(tasks)
+
+    if parent is not None and parent.history_cycles > 0:
+        sub_cols = np.full(len(agents) + 1, -1)
+        sub_cols[np.asarray(agent_positions) + 1] = np.arange(len(agent_positions))
+        previous = CycleIndex.of(tasks, agents).previous_assignment()[task_positions]
+        table.record(np.arange(len(task_positions)), sub_cols[previous])
+
+    return [Task.view(table, row) for row in range(len(task_positions))], sub_agents
+
+
+def assignment_vector(agents, tasks, assignments):
+    """ Converts {agent name: [task names]} into the assignment vector: agent index + 1 of each task, 0 if unassigned """
+    task_pos = {t.name: i for i, t in enumerate(tasks)}
+    assignment = np.zeros(len(task_pos), dtype=int)
+
+    for col, a in enumerate(agents, start=1):
+        assignment[[task_pos[t] for t in assignments.get(a.name, [])]] = col
+
+    return assignment
+
+
+def assignment_dict(agents, tasks, assignment):
+    """ Converts an assignment vector into {agent name: [task names]}, only for agents with assigned tasks """
+    assignments = {}
+
+    for i, col in enumerate(np.asarray(assignment).tolist()):
+        if col > 0:
+            assignments.setdefault(agents[col - 1].name, []).append(tasks[i].name)
+
+    return assignments
+
+
+def previous_incumbent(agents, tasks, values):
+    """
+    Feasible assignment vector for the cycle, built from the previous cycle's assignment: tasks keep their agent if
+    it is still available, overloaded agents drop their tasks of least value per weight, then the unassigned tasks
+    are inserted greedily by their best value. Returns the assignment and its objective.
+    """
+    tasks = list(tasks)
+    table, _ = _common_table(tasks)
+    _, _, weight_mat, compat = cycle_matrices(agents, tasks)
+    values = values if is_dense(values) else dense_values(compat, values)
+    capacities = np.array([a.capacity for a in agents])
+    task_ids = np.arange(len(tasks))
+
+    if table is None:
+        assignment = np.zeros(len(tasks), dtype=int)
+    else:
+        assignment = CycleIndex.of(tasks, agents).previous_assignment()
+
+    assigned = assignment > 0
+    assignment[assigned & (values[task_ids, assignment - 1] <= 0)] = 0
+    task_weights = weight_mat[task_ids, assignment - 1] * (assignment > 0)
+    loads = np.bincount(assignment, weights=task_weights, minlength=len(agents) + 1)[1:].astype(int)
+
+    # Repair capacity violations
+    for agent in np.flatnonzero(loads > capacities).tolist():
+        agent_tasks = np.flatnonzero(assignment == agent + 1)
+        density = values[agent_tasks, agent] / np.maximum(weight_mat[agent_tasks, agent], 1)
+
+        for task in agent_tasks[np.argsort(density, kind='stable')].tolist():
+            if loads[agent] <= capacities[agent]:
+                break
+
+            assignment[task] = 0
+            loads[agent] -= weight_mat[task, agent]
+
+    # Insert new and dropped tasks
+    candidates = np.where(compat & (values > 0), values, 0)
+    unassigned = np.flatnonzero((assignment == 0) & candidates.any(axis=1))
+
+    for task in unassigned[np.argsort(-candidates[unassigned].max(axis=1), kind='stable')].tolist():
+        fits = (candidates[task] > 0) & (loads + weight_mat[task] <= capacities)
+
+        if fits.any():
+            agent = int(np.argmax(np.where(fits, candidates[task], 0)))
+            assignment[task] = agent + 1
+            loads[agent] += weight_mat[task, agent]
+
+    assigned = assignment > 0
+    return assignment, values[assigned, assignment[assigned] - 1].sum()
+
+
+def check_assignment(compat, assignment):
+    """ Whether all assigned tasks are assigned to a compatible agent """
+    rows = np.flatnonzero(assignment)
+    return bool(np.all(compat[rows, assignment[rows] - 1]))
+
+
 def matrizes(agents, tasks, pad_dummy_agent=False):
+    tasks = list(tasks)
+    prof_mat, aff_mat, weight_mat, _ = cycle_matrices(agents, tasks)
+
+    if pad_dummy_agent:
+        prof_mat, aff_mat, weight_mat = (np.hstack((np.zeros((len(tasks), 1), dtype=int), m))
+                                         for m in (prof_mat, aff_mat, weight_mat))
+
+    return prof_mat, aff_mat, weight_mat
+
+
+def _task_matrizes(agents, tasks, pad_dummy_agent=False):
+    """ Matrices for tasks from different tables """
     prof_matrix = []
     affinity_matrix = []
     weight_matrix = []
@@ -0,0 +1,184 @@
+"""
+Binary instance format, used as sidecar cache next to the Prolog-style `.pl` instances.
+
+Layout: magic, format version and header length, a JSON header, followed by the raw arrays of
+`function.parse_instance`, each aligned to 64 bytes. The header describes dtype, shape and offset
+of every array and the source file it was created from (mtime, size and hash).
+Arrays are returned as read-only views into a memory map, so concurrent runs on the same instance
+share one page-cached copy.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+__all__ = ['SUFFIX', 'sidecar_path', 'write', 'read', 'load', 'convert']
+
+MAGIC = b'MCAPINST'
+VERSION = 1
+SUFFIX = '.bin'
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<8sII')
+
+
+def sidecar_path(instance):
+    return instance + SUFFIX
+
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def source_info(path, with_hash=True):
+    st = os.stat(path)
+    info = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+    if with_hash:
+        info['hash'] = file_hash(path)
+
+    return info
+
+
+def _compact(a):
+    if a.dtype.kind == 'i' and (a.size == 0 or (a.min() >= -2 ** 31 and a.max() < 2 ** 31)):
+        return a.astype(np.int32)
+
+    return a
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write(path, data, source=None):
+    """ Writes the arrays atomically, so readers never see partially written files """
+    arrays = {name: np.ascontiguousarray(_compact(np.asarray(a))) for name, a in data.items()}
+    layout = {}
+    offset = 0
+
+    for name, a in arrays.items():
+        layout[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+        offset = _aligned(offset + a.nbytes)
+
+    header = json.dumps({'source': source, 'arrays': layout}).encode('utf-8')
+    data_start = _aligned(PREAMBLE.size + len(header))
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+            f.write(header)
+
+            for name, a in arrays.items():
+                f.seek(data_start + layout[name]['offset'])
+                f.write(a.tobytes())
+
+            f.truncate(data_start + offset)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        magic, version, header_len = PREAMBLE.unpack(f.read(PREAMBLE.size))
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a binary instance (version %d)' % (path, VERSION))
+
+        header = json.loads(f.read(header_len).decode('utf-8'))
+
+    return header, _aligned(PREAMBLE.size + header_len)
+
+
+def read(path):
+    """ Returns the arrays of a binary instance as read-only views of a memory map """
+    header, data_start = read_header(path)
+    mm = np.memmap(path, dtype=np.uint8, mode='r')
+    data = {}
+
+    for name, spec in header['arrays'].items():
+        data[name] = np.ndarray(tuple(spec['shape']), dtype=np.dtype(spec['dtype']), buffer=mm,
+                                offset=data_start + spec['offset'])
+
+    return data
+
+
+def is_valid(cache_path, instance):
+    """
+    A cache is valid if the source has the recorded mtime and size, or failing that, the same content hash.
+    Returns the validity and whether the recorded source info is outdated.
+    """
+    try:
+        header, _ = read_header(cache_path)
+    except (OSError, ValueError, struct.error):
+        return False, True
+
+    cached = header.get('source') or {}
+    current = source_info(instance, with_hash=False)
+
+    if cached.get('mtime_ns') == current['mtime_ns'] and cached.get('size') == current['size']:
+        return True, False
+
+    return cached.get('size') == current['size'] and cached.get('hash') == file_hash(instance), True
+
+
+def load(instance, parse):
+    """
+    Returns the arrays of `instance` from its sidecar cache, (re-)creating the cache with `parse` if it
+    is missing or stale. Falls back to the parsed arrays if the cache cannot be written.
+    """
+    cache_path = sidecar_path(instance)
+    valid, outdated = is_valid(cache_path, instance)
+
+    if valid and not outdated:
+        return read(cache_path)
+
+    info = source_info(instance)
+    data = read(cache_path) if valid else parse(instance)
+
+    try:
+        write(cache_path, data, source=info)
+    except OSError:
+        return data
+
+    return read(cache_path)
+
+
+def convert(instance, outfile=None):
+    from function import parse_instance
+
+    outfile = outfile if outfile else sidecar_path(instance)
+    write(outfile, parse_instance(instance), source=source_info(instance))
+
+    return outfile
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts instances to the binary instance format')
+    parser.add_argument('instances', nargs='+')
+    parser.add_argument('-o', '--output_dir', default=None,
+                        help='Output directory, default: sidecar cache next to the instance')
+    args = parser.parse_args()
+
+    for instance in args.instances:
+        outfile = None
+
+        if args.output_dir:
+            outfile = os.path.join(args.output_dir, os.path.basename(instance) + SUFFIX)
+
+        print(convert(instance, outfile))
@@ -2,6 +2,7 @@ from __future__ import division
 
 import argparse
 import os
+import time
 
 import numpy as np
 
@@ -9,25 +10,38 @@ import copy
 
 import function
 import strategies
-from function import load_instance, all_assignable
-from problem import MaxAssignmentMinizinc, MultipleKnapsack
+from function import CycleSource
+from problem import (CachedSolutions, Decomposition, DynamicProgramming, MaxAssignmentGreedy, MaxAssignmentMilp,
+                     MaxAssignmentMinizinc, MultipleKnapsack, Portfolio, Presolve, ProblemWrapper, TimeBudget,
+                     solution_cache)
 
+PROBLEMS = ['max_assignment', 'max_assignment_cbc', 'milp', 'greedy', 'mulknap']
 
-def main(instance, strategy, problem, output_dir):
-    # Load instance
-    tasks, agents, task_availability, agent_availability, _ = load_instance(instance)
-    instance_name, _ = os.path.splitext(os.path.basename(instance))
+
+def main(instance, strategy, problem, output_dir, history_size=None, budget=None):
+    # Load instance, cycles are read on demand
+    source = CycleSource(instance, history_size=history_size)
+    tasks, agents, table = source.tasks, source.agents, source.table
+    instance_name = source.name
+
+    # With a run budget (in s), the timeout of each cycle is its share of the budget left
+    if budget is not None:
+        budget = TimeBudget(budget, source.cycle_costs(), timeout=problem.timeout)
 
     if str(problem) != 'mulknap':
         file_affix = '%s_%s' % (instance_name, strategy)
     else:
         file_affix = '%s_mulknap' % instance_name
 
+    # Hits and misses of the solution cache so far are logged with each cycle
+    cache = solution_cache(problem)
+
     log_file = open(os.path.join(output_dir, '%s_log.csv' % file_affix), 'w')
     log_header = ['instance', 'strategy', 'mode', 'cycle', 'objective',
                   'profit', 'affinity', 'pressure_max', 'pressure_mean',
                   'total_pressure_max', 'total_pressure_mean', 'assigned',
-                  'utilization', 'agents', 'tasks', 'timeout']
+                  'utilization', 'agents', 'tasks', 'timeout', 'allocated', 'consumed',
+                  'solver', 'cache_hits', 'cache_misses']
     log_template = ';'.join(('{%s}' % x for x in log_header))
     log_header_line = ';'.join(log_header)
     log_file.write('%s\n' % log_header_line)
@@ -37,59 +51,62 @@ def main(instance, strategy, problem, output_dir):
     assignment_header = ';'.join(['instance', 'strategy', 'cycle'] + [str(t) for t in tasks])
     assignment_file.write('%s\n' % assignment_header)
 
-    for i, (task_avail, agent_avail) in enumerate(zip(task_availability,
-                                                      agent_availability),
-                                                  start=1):
-        for x in task_avail:
-            tasks[x].update_profit()
+    for i, task_avail, agent_avail, cycle_profits in source.cycles():
+        rows = table.rows(task_avail)
+        table.update_profits(rows, cycle_profits[rows] if cycle_profits is not None else None)
 
         cycle_tasks = [tasks[x] for x in task_avail]
         cycle_agents = [agents[x] for x in agent_avail]
 
-        assert (all_assignable(cycle_tasks, cycle_agents))
+        index = function.CycleIndex.of(cycle_tasks, cycle_agents)
+        assert (index.all_assignable())
 
-        profits = strategy.profits(cycle_tasks, cycle_agents)
+        profits = strategy.cycle_values(cycle_tasks, cycle_agents)
         filename = '%s_%d_in.pl' % (file_affix, i)
-        cap_objective, solver_duration, cap_assignments = problem.optimize(cycle_tasks,
-                                                                           cycle_agents,
-                                                                           profits,
-                                                                           output_dir,
-                                                                           filename=filename)
-
-        # Negotation phase of two-step strategies, other strategies return the input
-        # Except the negotiation experiment, no strategy uses this
-        assignments, objective = strategy.exchange(cycle_agents, cycle_tasks,
-                                                   profits,
-                                                   cap_assignments,
-                                                   cap_objective)
 
-        all_assigned = []
-        prio = 0
-        aff = 0
-        utilization = []
+        if budget is not None:
+            problem.timeout = budget.allocate(i, len(cycle_tasks) * len(cycle_agents))
 
-        for agent_name, assigned_tasks in assignments.items():
-            assigned_weight = 0
+        allocated = problem.timeout
+        solve_start = time.time()
+        cap_objective, solver_duration, cap_assignment = problem.optimize(cycle_tasks,
+                                                                          cycle_agents,
+                                                                          profits,
+                                                                          output_dir,
+                                                                          filename=filename)
+        consumed = time.time() - solve_start
 
-            for t in assigned_tasks:
-                prio += tasks[t].profits[agent_name]
-                aff += tasks[t].affinities[agent_name]
-                assigned_weight += tasks[t].weights[agent_name]
-                tasks[t].update(agents[agent_name], agents)
-
-            utilization.append(float(assigned_weight) / agents[agent_name].capacity)
-            all_assigned.extend(assigned_tasks)
-
-        unassigned = set([t.name for t in cycle_tasks]) - set(all_assigned)
-
-        for t in unassigned:
-            tasks[t].update(None, agents)
-
-        pp_max = function.affinity_pressure(cycle_tasks, cycle_agents)
-        pp_mean = function.affinity_pressure_mean(cycle_tasks, cycle_agents)
-        total_pp_max = function.affinity_pressure(tasks.values())
-        total_pp_mean = function.affinity_pressure(tasks.values())
-        perc_assigned = len(all_assigned) / len(cycle_tasks)
+        # Negotation phase of two-step strategies, other strategies return the input
+        # Except the negotiation experiment, no strategy uses this
+        assignment, objective = strategy.exchange(cycle_agents, cycle_tasks,
+                                                  profits,
+                                                  cap_assignment,
+                                                  cap_objective)
+
+        # Assignment vector: agent index + 1 of each task, 0 if unassigned
+        assignment = np.asarray(assignment, dtype=int)
+        assigned_cols = np.where(assignment > 0, index.cols[assignment - 1], -1)
+        nb_assigned = np.count_nonzero(assignment)
+
+        # Utilization of the agents with assigned tasks
+        assigned_weights = table.weights[rows, assigned_cols] * (assignment > 0)
+        agent_weights = np.bincount(assignment, weights=assigned_weights, minlength=len(cycle_agents) + 1)[1:]
+        agent_used = np.bincount(assignment, minlength=len(cycle_agents) + 1)[1:] > 0
+        capacities = np.array([a.capacity for a in cycle_agents], dtype=float)
+        utilization = agent_weights[agent_used] / capacities[agent_used]
+
+        is_assigned = assigned_cols >= 0
+        prio = table.profits[rows[is_assigned], assigned_cols[is_assigned]].sum()
+        aff = table.affinity(rows[is_assigned], assigned_cols[is_assigned]).sum()
+        table.update(rows, assigned_cols)
+
+        cycle_pressures = table.pressures(index.rows, index.cols)
+        total_pressures = table.pressures()
+        pp_max = np.max(cycle_pressures)
+        pp_mean = np.mean(cycle_pressures)
+        total_pp_max = np.max(total_pressures)
+        total_pp_mean = np.max(total_pressures)
+        perc_assigned = nb_assigned / len(cycle_tasks)
 
         log_dict = {
             'instance': instance_name,
@@ -107,7 +124,12 @@ def main(instance, strategy, problem, output_dir):
             'utilization': np.round(np.mean(utilization), decimals=2),
             'agents': len(cycle_agents),
             'tasks': len(cycle_tasks),
-            'timeout': np.round(solver_duration, decimals=2)
+            'timeout': np.round(solver_duration, decimals=2),
+            'allocated': np.round(allocated, decimals=2) if allocated is not None else None,
+            'consumed': np.round(consumed, decimals=2),
+            'solver': getattr(problem, 'solved_by', problem),
+            'cache_hits': cache.hits if cache is not None else None,
+            'cache_misses': cache.misses if cache is not None else None
         }
 
         assert (all(x in log_dict for x in log_header))
@@ -116,37 +138,72 @@ def main(instance, strategy, problem, output_dir):
         print(log_entry)
         log_file.write('%s\n' % log_entry)
 
+        # Assigned agent of each task, 0 if unassigned and -1 if unavailable
         assignment_line = [instance_name, str(strategy), str(i)]
-
-        for t in tasks.values():
-            if t.name in all_assigned:
-                assignment_line.append(str(t.history[-1]))
-            elif t.name in unassigned:
-                assignment_line.append('0')
-            else:  # unavailable
-                assignment_line.append('-1')
+        assignment_line.extend(map(str, table.last_cycle().tolist()))
 
         assignment_file.write('%s\n' % ';'.join(assignment_line))
 
     log_file.close()
 
 
+def build_problem(name, args):
+    if name == 'max_assignment':
+        return MaxAssignmentMinizinc(timeout=args.timeout, fallback=args.fallback, gap=args.gap)
+    elif name == 'max_assignment_cbc':
+        return MaxAssignmentMinizinc(solver='cbc', timeout=args.timeout, fallback=args.fallback, gap=args.gap)
+    elif name == 'milp':
+        return MaxAssignmentMilp(timeout=args.timeout, fallback=args.fallback, gap=args.gap)
+    elif name == 'greedy':
+        return MaxAssignmentGreedy(deadline=args.deadline / 1000, lp_bound=args.lp_bound, gap=args.gap)
+    elif name == 'mulknap':
+        assert (args.strategy == 'profit')
+        return MultipleKnapsack()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('instance')
+    parser.add_argument('instance', help='Instance file or - to read the instance from stdin')
     parser.add_argument('strategy',
                         choices=strategies.STRATEGY_MAPPING.keys())
-    parser.add_argument('-p', '--problem', choices=['max_assignment', 'mulknap'],
-                        default='max_assignment')
+    parser.add_argument('-p', '--problem', choices=PROBLEMS, default='max_assignment')
+    parser.add_argument('--portfolio', default=None,
+                        help='Comma-separated problems raced on each cycle, instead of --problem '
+                             '(mulknap only with strategy profit)')
     parser.add_argument('-t', '--threshold',
                         help='Affinity Pressure Threshold (used with strategies adaptive and switch)',
                         type=float, default=3)
     parser.add_argument('--limit-assignments', action='store_true',
                         help='Limited assignment, disallow prev. agents')
     parser.add_argument('--timeout', type=int, default=60,
-                        help='CP solver timeout (in s)')
+                        help='Solver timeout (in s), the limit per cycle with --budget')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Time budget of the run (in s), shared by the cycles by their size')
+    parser.add_argument('--gap', type=float, default=None,
+                        help='Relative optimality gap at which a cycle is solved (max_assignment, milp, greedy)')
+    parser.add_argument('--deadline', type=int, default=50,
+                        help='Deadline of the greedy heuristic (in ms)')
+    parser.add_argument('--lp-bound', action='store_true',
+                        help='Report the gap of the greedy heuristic to the LP bound, within its deadline')
+    parser.add_argument('--presolve', action='store_true',
+                        help='Fix forced assignments and remove useless pairs before the solver solves the cycle')
+    parser.add_argument('--dp', action='store_true',
+                        help='Solve single-agent and subset-sum cycles by dynamic programming instead of the solver')
+    parser.add_argument('--solution-cache', default=None,
+                        help='Directory of the solution cache shared across runs, default: no cache')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='Maximum size of the solution cache (in MB)')
+    parser.add_argument('--decompose', action='store_true',
+                        help='Solve the connected components of the compatibility graph separately')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of processes solving components in parallel (with --decompose)')
     parser.add_argument('-o', '--output', default='results')
     parser.add_argument('--ind-weights', action='store_true', help='Use Individual Weights for WPP strategy')
+    parser.add_argument('--fallback', action='store_true',
+                        help='Keep the previous assignment, repaired for the cycle, if the solver returns a worse one '
+                             '(max_assignment, milp)')
+    parser.add_argument('--history-size', type=int, default=None,
+                        help='Keep the assignment history of the last cycles only (ring buffer)')
     args = parser.parse_args()
 
     if args.strategy == 'switch':
@@ -159,10 +216,34 @@ if __name__ == '__main__':
     if args.limit_assignments:
         strategy = strategies.LimitedAssignment(strategy)
 
-    if args.problem == 'max_assignment':
-        problem = MaxAssignmentMinizinc(timeout=args.timeout)
-    elif args.problem == 'mulknap':
-        problem = MultipleKnapsack()
-        assert (args.strategy == 'profit')
+    if args.portfolio:
+        names = args.portfolio.split(',')
+        assert (all(name in PROBLEMS for name in names))
+
+        # mulknap solves the profits, not the values of the strategy
+        if args.strategy != 'profit' and 'mulknap' in names:
+            print('Portfolio: mulknap only applies to strategy profit, skipped')
+            names.remove('mulknap')
+
+        problem = Portfolio([build_problem(name, args) for name in names], timeout=args.timeout)
+    else:
+        problem = build_problem(args.problem, args)
+
+    if args.solution_cache:
+        problem = CachedSolutions(problem, args.solution_cache, max_size=args.cache_size << 20)
+
+    if args.dp:
+        problem = DynamicProgramming(problem)
+
+    if args.decompose:
+        problem = Decomposition(problem, processes=args.processes)
+
+    if args.presolve:
+        problem = Presolve(problem)
 
-    main(args.instance, strategy, problem, args.output)
+    try:
+        main(args.instance, strategy, problem, args.output, args.history_size, args.budget)
+    finally:
+        # Shuts down the worker pool of --decompose
+        if isinstance(problem, ProblemWrapper):
+            problem.close()
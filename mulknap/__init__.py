@@ -56,7 +56,8 @@ def solve(profits, weights, capacities):
     objective = lib.mulknap(n, m, p, w, byref(assignment), c)
     duration = time.time() - start
 
-    adj_assignment = [agent_names[x-1] if x > 0 else 0 for x in assignment]
+    assignment = np.array(assignment)
+    adj_assignment = np.where(assignment > 0, agent_names[assignment - 1], 0)
 
     return objective, adj_assignment, duration
 
@@ -1,12 +1,23 @@
+import multiprocessing
 import os
+import queue
+import signal
 import subprocess
+import sys
 import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pymzn
+from scipy import sparse
+from scipy.optimize import Bounds, LinearConstraint, linprog, milp
+from scipy.sparse.csgraph import connected_components
 
 import mulknap
-from function import load_instance, matrizes
+from solution_cache import SolutionCache, cycle_key
+from function import (assignment_vector, check_assignment, cycle_matrices, dense_values, is_dense, load_instance,
+                      previous_incumbent, split_values, subcycle)
 
 
 def has_floats(x):
@@ -14,6 +25,66 @@ def has_floats(x):
     return np.any((x - x_int) != 0)
 
 
+class FallbackIncumbent(object):
+    """
+    The previous cycle's assignment, repaired for the cycle, see `function.previous_incumbent`. It is not handed to
+    the solver, neither the MiniZinc model nor SciPy's `milp` take a start, but kept if the solver returns a worse
+    solution, e.g. at the timeout.
+    """
+
+    def __init__(self, agents, tasks, values):
+        start = time.time()
+        self.assignment, self.objective = previous_incumbent(agents, tasks, values)
+        self.duration = time.time() - start
+
+    def better(self, objective, duration, assignment):
+        """ The better of the solver result and the incumbent, logs both objectives and durations """
+        kept = self.objective > objective
+
+        print('Fallback incumbent: %d (%.3f s) / Solver: %d (%.2f s) / Incumbent kept: %s' % (
+            self.objective, self.duration, objective, duration, kept))
+
+        if kept:
+            return int(self.objective), duration + self.duration, self.assignment
+
+        return objective, duration + self.duration, assignment
+
+
+class TimeBudget(object):
+    """
+    Wall-clock budget (in s) of a run, shared by its cycles in proportion to their cost (tasks x agents). Each cycle
+    gets its share of the budget left, so time unused by earlier cycles goes to later ones. Shares are capped at
+    `timeout`, if any, and at least `min_timeout`, but never exceed the budget left. Without the costs of all cycles
+    (e.g. on stdin), each cycle gets `timeout`, or the budget left, as long as the budget lasts. Cycles past the budget
+    get 1 ms, so that backends still return a solution without a timeout of 0 (no limit for some of them).
+    """
+
+    def __init__(self, budget, costs=None, timeout=60, min_timeout=0.1):
+        self.budget = budget
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.start = time.time()
+
+        # Cost of the remaining cycles, including the cycle itself
+        self.remaining_costs = None if costs is None else np.cumsum(np.asarray(costs, dtype=float)[::-1])[::-1]
+
+    def remaining(self):
+        return self.budget - (time.time() - self.start)
+
+    def allocate(self, cycle, cost):
+        """ Timeout of the cycle (1-based) """
+        remaining = self.remaining()
+
+        if self.remaining_costs is None:
+            share = remaining
+        else:
+            share = remaining * cost / max(self.remaining_costs[cycle - 1], 1)
+
+        share = max(self.min_timeout, share if self.timeout is None else min(self.timeout, share))
+
+        return max(min(share, remaining), 1e-3)
+
+
 class MaxAssignment(object):
     def __init__(self, timeout=60):
         self.timeout = timeout
@@ -24,7 +95,7 @@ class MaxAssignment(object):
         outfile = infile.replace('_in.pl', '_out.pl')
 
         if os.path.isfile('maxassign.exe'):
-            cmds = ['./maxassign.exe', infile, outfile, str(self.timeout * 1000)]
+            cmds = ['./maxassign.exe', infile, outfile, str(int(self.timeout * 1000))]
         else:
             cmds = ['sicstus', '--nologo', '--noinfo', '-l', 'maxassign.pl',
                     '--goal', "go('%s', '%s', %d),halt." % (infile, outfile,
@@ -37,14 +108,18 @@ class MaxAssignment(object):
         # timeout_flag = output_lines[-2].decode("utf-8")
         objective = int(output_lines[-1])
 
-        _, _, _, _, assignments = load_instance(outfile)
+        _, _, _, _, assignments = load_instance(outfile, cache=False)
 
-        return objective, duration, assignments
+        return objective, duration, assignment_vector(agents, tasks, assignments)
 
     def export_cycle(self, tasks, agents, profits, filename=None,
                      directory='/tmp'):
         outfile = os.path.join(directory, filename)
-        agent_names = [a.name for a in agents]
+        agent_names = np.array([a.name for a in agents])
+        _, _, weight_mat, compat = cycle_matrices(agents, tasks)
+
+        if is_dense(profits):
+            profits = split_values(compat, profits)
 
         with open(outfile, 'w') as f:
             for a in agents:
@@ -52,14 +127,10 @@ class MaxAssignment(object):
 
             f.write('\n')
 
-            for t, p in zip(tasks, profits):
+            for t, p, w, c in zip(tasks, profits, weight_mat, compat):
                 prios = ",".join(map(str, p))
-                weights = [str(v) for k, v in t.weights.items() if k in
-                           agent_names]
-                weights = ",".join(weights)
-                avail_agents = [str(x) for x in t.profits.keys() if x in
-                                agent_names]
-                poss_agents = ",".join(avail_agents)
+                weights = ",".join(map(str, w[c].tolist()))
+                poss_agents = ",".join(map(str, agent_names[c].tolist()))
                 stringrep = "task(%d,[%s],[%s],[%s])." % (t.name, weights,
                                                           prios, poss_agents)
                 f.write('%s\n' % stringrep)
@@ -68,52 +139,59 @@ class MaxAssignment(object):
 
 
 class MaxAssignmentMinizinc(object):
-    def __init__(self, solver='cplex', timeout=60):
+    def __init__(self, solver='cplex', timeout=60, fallback=False, gap=None):
         self.timeout = timeout
+        self.fallback = fallback
+        self.gap = gap
+        self.optimal = False
         self.solver = solver
-        if solver == 'cplex':
-            self.solver = MinizincSolver(solver='cplex')
+        if solver in ('cplex', 'cbc'):
+            self.solver = MinizincSolver(solver=solver)
         else:
             self.solver = solver
 
     def optimize(self, tasks, agents, profits, directory, filename=None):
+        incumbent = FallbackIncumbent(agents, tasks, profits) if self.fallback else None
+
         # The model only processes ints, but some strategies might deliver floats
-        multiplier = 100 if any(has_floats(p) for p in profits) else 1
-        profits = [np.round(p * multiplier).astype(int) for p in profits]
+        if is_dense(profits):
+            multiplier = 100 if has_floats(profits) else 1
+            profits = np.round(profits * multiplier).astype(int)
+        else:
+            multiplier = 100 if any(has_floats(p) for p in profits) else 1
+            profits = [np.round(p * multiplier).astype(int) for p in profits]
 
         infile = self.export_cycle(tasks, agents, profits, filename, directory)
 
+        # Relative optimality gap to stop at, MIP solvers only
+        options = {'rel_gap': self.gap} if self.gap else {}
+
         start = time.time()
         # Timeout: CBC/Cplex use seconds, check for other solvers if needed
         output = pymzn.minizinc('maxassign.mzn', infile + '.dzn',
-                                solver=self.solver, timeout=self.timeout)
+                                solver=self.solver, timeout=self.timeout, **options)
         duration = time.time() - start
+        self.optimal = output.status == pymzn.Status.COMPLETE
         objective = output[0]['objective']
         assignment_mat = output[0]['assignment']
 
-        am = np.array(assignment_mat).reshape((len(tasks), len(agents)))
-        assigned_tasks, assigned_to = np.nonzero(am)
-
-        assignments = {}
-
-        for (row_idx, col_idx) in zip(assigned_tasks, assigned_to):
-            agent_name = agents[col_idx].name
-            task_name = tasks[row_idx].name
+        am = np.array(assignment_mat, dtype=bool).reshape((len(tasks), len(agents)))
+        assignment = np.where(am.any(axis=1), am.argmax(axis=1) + 1, 0)
 
-            assert (agent_name in tasks[row_idx].poss_agents)
-
-            if agent_name in assignments:
-                assignments[agent_name].append(task_name)
-            else:
-                assignments[agent_name] = [task_name]
+        _, _, _, compat = cycle_matrices(agents, tasks)
+        assert (check_assignment(compat, assignment))
 
         objective /= multiplier
 
-        return int(objective), duration, assignments
+        if incumbent is not None:
+            return incumbent.better(int(objective), duration, assignment)
+
+        return int(objective), duration, assignment
 
     def export_cycle(self, tasks, agents, profits, filename=None, directory='/tmp'):
         outfile = os.path.join(directory, filename)
-        agent_names = [a.name for a in agents]
+        _, _, weight_mat, compat = cycle_matrices(agents, tasks)
+        profit_mat = profits if is_dense(profits) else dense_values(compat, profits)
 
         with open(outfile + '.dzn', 'w') as f:
             capacities = ", ".join((str(a.capacity) for a in agents))
@@ -125,73 +203,787 @@ class MaxAssignmentMinizinc(object):
             profitlines = 'profits=[|'
             weightlines = 'weights=[|'
             compatlines = 'compat=['
+            agent_ids = np.arange(1, len(agents) + 1)
 
-            for t, prof in zip(tasks, profits):
-                profitlines += '\n'
-                weightlines += '\n'
-                compatlines += '\n'
+            for prof, weights, comp in zip(profit_mat.tolist(), weight_mat.tolist(), compat):
+                profitlines += '\n%s|' % ", ".join(map(str, prof))
+                weightlines += '\n%s|' % ", ".join(map(str, weights))
+                compatlines += '\n{ %s }, ' % ", ".join(map(str, agent_ids[comp].tolist()))
 
-                avail_agents = [a for a in agent_names if a in t.poss_agents]
-                profdict = {a: p for a, p in zip(avail_agents, prof)}
-                full_profits = []
-                full_weights = []
-                compat = []
+            f.write(profitlines + '];\n')
+            f.write(weightlines + '];\n')
+            f.write(compatlines + '];\n')
 
-                for i, a in enumerate(agents, start=1):
-                    if a.name in profdict:
-                        full_profits.append(str(profdict[a.name]))
-                        full_weights.append(str(t.weights[a.name]))
-                        compat.append(str(i))
-                    else:
-                        full_profits.append('0')
-                        full_weights.append('0')
+        return outfile
 
-                pline = ", ".join(full_profits)
-                profitlines += '%s|' % pline
+    def __str__(self):
+        solver = getattr(self.solver, 'solver', self.solver)
+        return 'max_assignment' if solver == 'cplex' else 'max_assignment_%s' % solver
 
-                wline = ", ".join(full_weights)
-                weightlines += '%s|' % wline
 
-                cline = ", ".join(compat)
-                compatlines += '{ %s }, ' % cline
+def gap_constraints(weight_mat, compat, capacities):
+    """
+    The cycle as generalized assignment problem: one variable per compatible pair (`rows`, `cols`), tasks are
+    assigned at most once and agents stay within their capacity. Returns the pairs and the constraints.
+    """
+    rows, cols = np.nonzero(compat)
+    variables = np.arange(len(rows))
+    task_constraints = sparse.csr_array((np.ones(len(rows)), (rows, variables)), shape=(compat.shape[0], len(rows)))
+    agent_constraints = sparse.csr_array((weight_mat[rows, cols], (cols, variables)),
+                                         shape=(compat.shape[1], len(rows)))
 
-            f.write(profitlines + '];\n')
-            f.write(weightlines + '];\n')
-            f.write(compatlines + '];\n')
+    return rows, cols, LinearConstraint(sparse.vstack((task_constraints, agent_constraints)),
+                                        ub=np.concatenate((np.ones(compat.shape[0]), capacities)))
 
-        return outfile
+
+class MaxAssignmentMilp(object):
+    """ The cycle as generalized assignment MIP, solved in-process by HiGHS """
+
+    def __init__(self, timeout=60, fallback=False, gap=None):
+        self.timeout = timeout
+        self.fallback = fallback
+        self.gap = gap
+        self.optimal = False
+
+    def optimize(self, tasks, agents, profits, directory, filename=None):
+        _, _, weight_mat, compat = cycle_matrices(agents, tasks)
+        profit_mat = profits if is_dense(profits) else dense_values(compat, profits)
+        capacities = np.array([a.capacity for a in agents])
+        incumbent = FallbackIncumbent(agents, tasks, profit_mat) if self.fallback else None
+
+        rows, cols, constraints = gap_constraints(weight_mat, compat, capacities)
+
+        options = {'time_limit': self.timeout}
+
+        if self.gap:
+            options['mip_rel_gap'] = self.gap
+
+        start = time.time()
+        result = milp(-profit_mat[rows, cols], constraints=constraints, integrality=np.ones(len(rows)),
+                      bounds=Bounds(0, 1), options=options)
+        duration = time.time() - start
+        self.optimal = result.status == 0
+
+        assignment = np.zeros(len(tasks), dtype=int)
+
+        # Without a feasible solution in time, no task is assigned
+        if result.x is not None:
+            selected = result.x > 0.5
+            assignment[rows[selected]] = cols[selected] + 1
+
+        assert (check_assignment(compat, assignment))
+
+        is_assigned = assignment > 0
+        objective = profit_mat[is_assigned, assignment[is_assigned] - 1].sum()
+
+        if incumbent is not None:
+            return incumbent.better(int(objective), duration, assignment)
+
+        return int(objective), duration, assignment
+
+    def __str__(self):
+        return 'milp'
+
+
+class MaxAssignmentGreedy(object):
+    """
+    Regret heuristic for the cycle GAP (Martello & Toth): tasks with the largest difference between their best and
+    second best fitting agent are assigned first. The assignment is then improved by shifts and swaps of tasks until
+    no step improves, the `deadline` (in s) is reached or the relative `gap` to the LP bound is closed. A `timeout`,
+    e.g. of a portfolio or budget, only shortens the deadline. The LP bound is computed with a gap, or to report the
+    gap if `lp_bound` is True, and counts against the deadline.
+    Matrices are padded with agent 0 for unassigned tasks, so that assignment vectors index them directly.
+    """
+
+    def __init__(self, deadline=0.05, timeout=None, lp_bound=False, gap=None):
+        self.deadline = deadline
+        self.timeout = timeout
+        self.lp_bound = lp_bound
+        self.gap = gap
+        self.optimal = False
+
+    def optimize(self, tasks, agents, profits, directory, filename=None):
+        start = time.time()
+        deadline = start + (self.deadline if self.timeout is None else min(self.deadline, self.timeout))
+
+        _, _, weight_mat, compat = cycle_matrices(agents, tasks)
+        profit_mat = profits if is_dense(profits) else dense_values(compat, profits)
+        capacities = np.array([a.capacity for a in agents])
+
+        values = np.hstack((np.zeros((len(tasks), 1)), np.where(compat, profit_mat, 0)))
+        weights = np.hstack((np.zeros((len(tasks), 1), dtype=int), weight_mat))
+        allowed = np.hstack((np.ones((len(tasks), 1), dtype=bool), compat & (profit_mat > 0)))
+        capacities = np.concatenate(([np.iinfo(int).max // 2], capacities))
+
+        assignment = self.construct(values, weights, allowed, capacities, deadline)
+        bound = None
+
+        # The bound gets the time left after the construction, so that there is a solution at the deadline
+        if self.lp_bound or self.gap:
+            bound = self.bound(profit_mat, weight_mat, compat, capacities[1:], deadline - time.time())
+
+        target = bound * (1 - self.gap) if self.gap and bound is not None else np.inf
+
+        assignment = self.improve(values, weights, allowed, capacities, assignment, deadline, target=target)
+
+        assert (check_assignment(compat, assignment))
+
+        objective = values[np.arange(len(tasks)), assignment].sum()
+
+        # With int values, the optimum is at most the bound rounded down
+        self.optimal = bound is not None and bound - objective < (1e-6 if has_floats(profit_mat) else 1)
+        duration = time.time() - start
+
+        if self.lp_bound:
+            if bound is None:
+                print('Greedy: %d / LP bound: - / Time: %.3f' % (objective, duration))
+            else:
+                print('Greedy: %d / LP bound: %.1f / Gap: %.2f%% / Time: %.3f' % (
+                    objective, bound, 100 * (bound - objective) / max(bound, 1), duration))
+
+        return int(objective), duration, assignment
+
+    @staticmethod
+    def bound(profit_mat, weight_mat, compat, capacities, time_limit):
+        """ LP relaxation bound of the cycle, None if not solved within `time_limit` (in s) """
+        rows, cols, constraints = gap_constraints(weight_mat, compat, capacities)
+        result = linprog(-profit_mat[rows, cols], A_ub=constraints.A, b_ub=constraints.ub, bounds=(0, 1),
+                         method='highs', options={'time_limit': max(time_limit, 1e-3)})
+
+        return -result.fun if result.status == 0 else None
+
+    @staticmethod
+    def construct(values, weights, allowed, capacities, deadline):
+        """
+        Assigns the tasks by decreasing regret in rounds: regrets are computed for all open tasks at once, then each
+        task takes its best agent if it still fits. Tasks whose best agent filled up wait for the next round.
+        """
+        assignment = np.zeros(len(values), dtype=int)
+        loads = np.zeros(len(capacities), dtype=int)
+        open_tasks = np.arange(len(values))
+
+        while len(open_tasks) > 0 and time.time() < deadline:
+            fits = allowed[open_tasks] & (loads + weights[open_tasks] <= capacities)
+            fits[:, 0] = False
+            desirability = np.where(fits, values[open_tasks], -np.inf)
+
+            open_tasks = open_tasks[fits.any(axis=1)]
+            desirability = desirability[fits.any(axis=1)]
+
+            if len(open_tasks) == 0:
+                break
+
+            best_agents = np.argmax(desirability, axis=1)
+            ranked = np.sort(desirability, axis=1)
+            regrets = np.where(np.isfinite(ranked[:, -2]), ranked[:, -1] - ranked[:, -2], np.inf)
+
+            nb_assigned = 0
+            loads_list, caps_list = loads.tolist(), capacities.tolist()
+
+            for i in np.argsort(-regrets, kind='stable').tolist():
+                task, agent = open_tasks[i], best_agents[i]
+                weight = weights[task, agent]
+
+                if loads_list[agent] + weight <= caps_list[agent]:
+                    loads_list[agent] += weight
+                    assignment[task] = agent
+                    nb_assigned += 1
+
+            loads = np.array(loads_list)
+            open_tasks = open_tasks[assignment[open_tasks] == 0]
+
+            if nb_assigned == 0:
+                break
+
+        return assignment
+
+    @staticmethod
+    def improve(values, weights, allowed, capacities, assignment, deadline, check_interval=32, target=np.inf):
+        """
+        Applies the best shift of a task to another agent (or unassigned) while one improves. Otherwise the first
+        improving swap of two tasks of different agents, where a task may also take the place of an assigned one.
+        Stops once the objective reaches `target`.
+        """
+        task_ids = np.arange(len(values))
+        loads = np.bincount(assignment, weights=weights[task_ids, assignment], minlength=len(capacities)).astype(int)
+
+        while time.time() < deadline:
+            current = values[task_ids, assignment]
+
+            if current.sum() >= target:
+                break
+
+            # Shifts
+            gains = values - current[:, np.newaxis]
+            feasible = allowed & (loads + weights <= capacities) & (gains > 0)
+
+            if feasible.any():
+                task, agent = np.unravel_index(np.argmax(np.where(feasible, gains, 0)), feasible.shape)
+                loads[assignment[task]] -= weights[task, assignment[task]]
+                loads[agent] += weights[task, agent]
+                assignment[task] = agent
+                continue
+
+            # Swaps
+            swapped = False
+
+            for i, task in enumerate(np.argsort(current, kind='stable').tolist()):
+                if i % check_interval == 0 and time.time() > deadline:
+                    break
+
+                agent = assignment[task]
+                others = assignment
+                gains = values[task, others] + values[:, agent] - current[task] - current
+                feasible = (allowed[task, others] & allowed[:, agent] & (others != agent) & (gains > 0) &
+                            (loads[agent] - weights[task, agent] + weights[:, agent] <= capacities[agent]) &
+                            (loads[others] - weights[task_ids, others] + weights[task, others] <= capacities[others]))
+
+                if feasible.any():
+                    other = int(np.argmax(np.where(feasible, gains, 0)))
+                    other_agent = assignment[other]
+                    loads[agent] += weights[other, agent] - weights[task, agent]
+                    loads[other_agent] += weights[task, other_agent] - weights[other, other_agent]
+                    assignment[task], assignment[other] = other_agent, agent
+                    swapped = True
+                    break
+
+            if not swapped:
+                break
+
+        return assignment
+
+    def __str__(self):
+        return 'greedy'
 
 
 class MultipleKnapsack(object):
     def __init__(self, timeout=60):
         self.timeout = timeout
+        self.optimal = True
 
     def optimize(self, tasks, agents, profits, directory, filename=None):
-        p, _, w = matrizes(agents, tasks, pad_dummy_agent=False)
+        p, _, w, compat = cycle_matrices(agents, tasks)
         capacities = [a.capacity for a in agents]
 
         objective, assignment, duration = mulknap.solve(p, w, capacities)
+        assert (check_assignment(compat, assignment))
+
+        return int(objective), duration, assignment
+
+    def __str__(self):
+        return 'mulknap'
+
+
+def compatibility_components(compat):
+    """ Connected components of the bipartite tasks x agents compatibility graph, as labels of tasks and agents """
+    graph = sparse.bmat([[None, sparse.csr_array(compat)], [sparse.csr_array(compat.T), None]])
+    _, labels = connected_components(graph, directed=False)
+
+    return labels[:compat.shape[0]], labels[compat.shape[0]:]
+
+
+def solve_component(problem, tasks, agents, values, directory, filename):
+    """ Solves a component, also returns the backend which solved it and the cache hits and misses it took """
+    start = time.time()
+    cache = solution_cache(problem)
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    objective, _, assignment = problem.optimize(tasks, agents, values, directory, filename=filename)
+
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+
+    return objective, time.time() - start, assignment, getattr(problem, 'solved_by', str(problem)), (hits, misses)
+
+
+class ProblemWrapper(object):
+    """ Base of problems which hand (parts of) the cycle to `problem`, the timeout is the one of `problem` """
 
-        assignments = {}
+    def __init__(self, problem):
+        self.problem = problem
 
-        for i, agidx in enumerate(assignment):
-            if agidx == 0:
+    @property
+    def timeout(self):
+        return getattr(self.problem, 'timeout', None)
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.problem.timeout = timeout
+
+    @property
+    def solved_by(self):
+        """ Backend which solved the last cycle """
+        return getattr(self.problem, 'solved_by', str(self.problem))
+
+    def close(self):
+        """ Releases the resources of the wrapped problems, e.g. worker pools """
+        if hasattr(self.problem, 'close'):
+            self.problem.close()
+
+    def __str__(self):
+        return str(self.problem)
+
+
+class Decomposition(ProblemWrapper):
+    """
+    Solves the connected components of the cycle's compatibility graph with `problem` as independent subproblems,
+    on a pool of `processes` processes if more than one, and merges their assignments.
+    """
+
+    def __init__(self, problem, processes=1):
+        super().__init__(problem)
+        self.processes = processes
+        self.pool = None
+        self.component_solvers = None
+
+    def optimize(self, tasks, agents, profits, directory, filename=None):
+        start = time.time()
+        _, _, _, compat = cycle_matrices(agents, tasks)
+        values = profits if is_dense(profits) else dense_values(compat, profits)
+        task_labels, agent_labels = compatibility_components(compat)
+
+        # Agents without any compatible task form components on their own, tasks without agents stay unassigned
+        components = np.unique(task_labels)
+
+        self.component_solvers = None
+
+        if len(components) == 1:
+            return self.problem.optimize(tasks, agents, profits, directory, filename=filename)
+
+        parts = []
+
+        for component in components.tolist():
+            task_positions = np.flatnonzero(task_labels == component)
+            agent_positions = np.flatnonzero(agent_labels == component)
+
+            if len(agent_positions) == 0:
                 continue
 
-            agent_name = agents[agidx - 1].name
-            task_name = tasks[i].name
+            sub_tasks, sub_agents = subcycle(agents, tasks, task_positions, agent_positions)
+            sub_filename = filename.replace('_in.pl', '_c%d_in.pl' % component) if filename else None
+            parts.append((task_positions, agent_positions,
+                          (self.problem, sub_tasks, sub_agents, values[np.ix_(task_positions, agent_positions)],
+                           directory, sub_filename)))
+
+        if self.processes > 1:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.processes)
+
+            results = list(self.pool.map(solve_component, *zip(*(args for _, _, args in parts))))
+        else:
+            results = [solve_component(*args) for _, _, args in parts]
+
+        assignment = np.zeros(len(tasks), dtype=int)
+
+        # Components solved in the pool looked up copies of the cache
+        cache = solution_cache(self.problem)
+
+        if self.processes > 1 and cache is not None:
+            cache.hits += sum(hits for *_, (hits, _) in results)
+            cache.misses += sum(misses for *_, (_, misses) in results)
+
+        for i, ((task_positions, agent_positions, _), (sub_objective, duration, sub_assignment, _, _)) in enumerate(
+                zip(parts, results)):
+            assigned = sub_assignment > 0
+            assignment[task_positions[assigned]] = agent_positions[sub_assignment[assigned] - 1] + 1
+
+            print('Component %d: Tasks: %d / Agents: %d / Objective: %d / Time: %.3f' % (
+                i, len(task_positions), len(agent_positions), sub_objective, duration))
+
+        self.component_solvers = sorted(set(solved_by for _, _, _, solved_by, _ in results))
+
+        assert (check_assignment(compat, assignment))
+
+        # Objectives of the components are rounded down, the one of the cycle only once
+        is_assigned = assignment > 0
+        objective = values[is_assigned, assignment[is_assigned] - 1].sum()
+
+        return int(objective), time.time() - start, assignment
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+        super().close()
+
+    @property
+    def solved_by(self):
+        """ Backends which solved the components of the last cycle """
+        if self.component_solvers is None:
+            return super().solved_by
+
+        return '+'.join(map(str, self.component_solvers))
+
+
+class Presolve(ProblemWrapper):
+    """
+    Reduces the cycle before `problem` solves it, all reductions keep the optimum:
+    - pairs without value or which never fit into the agent are removed, tasks without pairs stay unassigned
+    - tasks whose best agent can take all its remaining tasks are assigned to it, until no such task is left
+    - if the best agents of all remaining tasks can take them, the cycle is solved without the problem
+    The solution of the reduced cycle is mapped back, the eliminated tasks and agents are reported.
+    """
+
+    def __init__(self, problem):
+        super().__init__(problem)
+        self.solved = False
+
+    def optimize(self, tasks, agents, profits, directory, filename=None):
+        start = time.time()
+        tasks = list(tasks)
+        _, _, weight_mat, compat = cycle_matrices(agents, tasks)
+        values = profits if is_dense(profits) else dense_values(compat, profits)
+        capacities = np.array([a.capacity for a in agents])
+        task_ids = np.arange(len(tasks))
+
+        allowed = compat & (values > 0) & (weight_mat <= capacities)
+        nb_removed = np.count_nonzero(compat & ~allowed)
+        open_tasks = allowed.any(axis=1)
+        nb_unassignable = len(tasks) - np.count_nonzero(open_tasks)
+
+        assignment = np.zeros(len(tasks), dtype=int)
+        best_agents = np.argmax(np.where(allowed, values, -np.inf), axis=1)
+
+        # Fix tasks at their best agent if it is not binding
+        while True:
+            open_allowed = allowed & open_tasks[:, np.newaxis]
+            demand = (weight_mat * open_allowed).sum(axis=0)
+            fixed = open_tasks & (demand <= capacities)[best_agents]
+
+            if not fixed.any():
+                break
+
+            assignment[fixed] = best_agents[fixed] + 1
+            capacities = capacities - np.bincount(best_agents[fixed], weights=weight_mat[fixed, best_agents[fixed]],
+                                                  minlength=len(agents)).astype(int)
+            open_tasks &= ~fixed
+
+        nb_fixed = np.count_nonzero(assignment)
+        open_allowed = allowed & open_tasks[:, np.newaxis]
+        task_positions = np.flatnonzero(open_tasks)
+        agent_positions = np.flatnonzero(open_allowed.any(axis=0))
+
+        # Everything left fits into the best agents
+        best_loads = np.bincount(best_agents[open_tasks], weights=weight_mat[open_tasks, best_agents[open_tasks]],
+                                 minlength=len(agents))
+        solved = bool(np.all(best_loads <= capacities))
+        self.solved = solved or len(task_positions) == 0
+
+        if solved:
+            assignment[open_tasks] = best_agents[open_tasks] + 1
+        elif len(task_positions) > 0:
+            sub_tasks, sub_agents = subcycle(agents, tasks, task_positions, agent_positions, available=allowed,
+                                             capacities=capacities[agent_positions])
+            sub_values = (values * allowed)[np.ix_(task_positions, agent_positions)]
+            _, _, sub_assignment = self.problem.optimize(sub_tasks, sub_agents, sub_values, directory,
+                                                         filename=filename)
+
+            assigned = sub_assignment > 0
+            assignment[task_positions[assigned]] = agent_positions[sub_assignment[assigned] - 1] + 1
+
+        assert (check_assignment(allowed, assignment))
+
+        is_assigned = assignment > 0
+        objective = values[task_ids[is_assigned], assignment[is_assigned] - 1].sum()
+
+        print('Presolve: Fixed: %d / Unassignable: %d / Removed pairs: %d / Tasks left: %d of %d / '
+              'Agents left: %d of %d / Solved: %s' % (
+                  nb_fixed, nb_unassignable, nb_removed, 0 if solved else len(task_positions), len(tasks),
+                  0 if solved else len(agent_positions), len(agents), solved))
+
+        return int(objective), time.time() - start, assignment
+
+    @property
+    def solved_by(self):
+        return 'presolve' if self.solved else super().solved_by
+
+
+def knapsack(values, weights, capacity):
+    """
+    0/1 knapsack by dynamic programming over the capacity, one vectorized step per item.
+    Returns the best value and the selected items.
+    """
+    best = np.zeros(capacity + 1)
+    taken = np.zeros((len(values), capacity + 1), dtype=bool)
+
+    for i, (value, weight) in enumerate(zip(values.tolist(), weights.tolist())):
+        if weight > capacity:
+            continue
+
+        candidates = best[:capacity + 1 - weight] + value
+        taken[i, weight:] = candidates > best[weight:]
+        best[weight:] = np.maximum(best[weight:], candidates)
+
+    selected = np.zeros(len(values), dtype=bool)
+    remaining = capacity
+
+    for i in range(len(values) - 1, -1, -1):
+        if taken[i, remaining]:
+            selected[i] = True
+            remaining -= weights[i]
+
+    return best[capacity], selected
+
+
+class DynamicProgramming(ProblemWrapper):
+    """
+    Solves single-agent cycles and subset-sum cycles (values equal weights) by knapsack dynamic programming instead
+    of `problem`, if the tables have at most `max_cells` cells. Subset-sum cycles with several agents are filled agent
+    by agent, which is optimal only if it uses all capacity or assigns all tasks, otherwise `problem` solves the cycle.
+    """
+
+    def __init__(self, problem, max_cells=1 << 24):
+        super().__init__(problem)
+        self.max_cells = max_cells
+        self.nb_solved = 0
+        self.nb_delegated = 0
+        self.solved = False
+
+    def optimize(self, tasks, agents, profits, directory, filename=None):
+        start = time.time()
+        _, _, weight_mat, compat = cycle_matrices(agents, tasks)
+        values = profits if is_dense(profits) else dense_values(compat, profits)
+        capacities = np.array([a.capacity for a in agents])
+
+        allowed = compat & (values > 0) & (weight_mat <= capacities)
+        subset_sum = np.array_equal(values[allowed], weight_mat[allowed])
+        self.solved = False
+
+        if not (len(agents) == 1 or subset_sum) or len(tasks) * (capacities.max(initial=0) + 1) > self.max_cells:
+            self.nb_delegated += 1
+            return self.problem.optimize(tasks, agents, profits, directory, filename=filename)
+
+        assignment = np.zeros(len(tasks), dtype=int)
+
+        # Small agents first, larger ones are more likely to be filled by the tasks left
+        for agent in np.argsort(capacities, kind='stable').tolist():
+            items = np.flatnonzero(allowed[:, agent] & (assignment == 0))
+            _, selected = knapsack(values[items, agent], weight_mat[items, agent], capacities[agent])
+            assignment[items[selected]] = agent + 1
+
+        assert (check_assignment(allowed, assignment))
+
+        is_assigned = assignment > 0
+        objective = values[is_assigned, assignment[is_assigned] - 1].sum()
+        bound = min(capacities.sum(), np.where(allowed, values, 0).max(axis=1, initial=0).sum())
+        optimal = len(agents) == 1 or objective >= bound
+        duration = time.time() - start
 
-            assert (agent_name in tasks[i].poss_agents)
+        print('DP: Agents: %d / Subset sum: %s / Objective: %d / Optimal: %s / Time: %.4f' % (
+            len(agents), subset_sum, objective, optimal, duration))
 
-            if agent_name in assignments:
-                assignments[agent_name].append(task_name)
+        if not optimal:
+            self.nb_delegated += 1
+            return self.problem.optimize(tasks, agents, profits, directory, filename=filename)
+
+        self.nb_solved += 1
+        self.solved = True
+
+        return int(objective), duration, assignment
+
+    @property
+    def solved_by(self):
+        return 'dp' if self.solved else super().solved_by
+
+
+def solver_key(problem):
+    """
+    Backend and the settings its solutions depend on: solver, gap, fallback incumbent, LP bound and deadline. The
+    timeout is not part of it, see `CachedSolutions`, neither are results and counters kept between cycles. Wrappers
+    are keyed by the problem they wrap, portfolios by all their backends.
+    """
+    if isinstance(problem, Portfolio):
+        return 'Portfolio(%s)' % ', '.join(solver_key(p) for p in problem.problems)
+
+    if isinstance(problem, ProblemWrapper):
+        return '%s(%s)' % (type(problem).__name__, solver_key(problem.problem))
+
+    # Solver objects by their solver name, or their type if they have none
+    solver = getattr(problem, 'solver', None)
+    solver = getattr(solver, 'solver', solver)
+
+    if solver is not None and not isinstance(solver, str):
+        solver = type(solver).__name__
+
+    settings = (type(problem).__name__, solver, getattr(problem, 'gap', None), getattr(problem, 'fallback', None),
+                getattr(problem, 'lp_bound', None), getattr(problem, 'deadline', None))
+
+    return repr(settings)
+
+
+def solution_cache(problem):
+    """ The solution cache of `problem` or of the problems it wraps, None if there is none """
+    while isinstance(problem, ProblemWrapper):
+        if isinstance(problem, CachedSolutions):
+            return problem.cache
+
+        problem = problem.problem
+
+    return None
+
+
+class CachedSolutions(ProblemWrapper):
+    """
+    Looks each cycle up in the on-disk solution cache in `directory` before `problem` solves it, solutions are stored
+    for later cycles and runs. Keyed by the cycle input and the backend settings, not by the fallback incumbent: a
+    cached solution was found for the same cycle, but possibly against a different incumbent. Solutions proven optimal
+    are reused under any timeout, others only under the timeout they were found with.
+    """
+
+    def __init__(self, problem, directory, max_size=1 << 30):
+        super().__init__(problem)
+        self.cache = SolutionCache(directory, max_size=max_size)
+        self.hit = False
+
+    def optimize(self, tasks, agents, profits, directory, filename=None):
+        start = time.time()
+        _, _, weight_mat, compat = cycle_matrices(agents, tasks)
+        values = profits if is_dense(profits) else dense_values(compat, profits)
+        capacities = np.array([a.capacity for a in agents])
+        solver = solver_key(self.problem)
+        key = cycle_key(solver, capacities, weight_mat, values, compat)
+
+        cached = self.cache.get(key, timeout=self.timeout)
+        self.hit = cached is not None
+
+        if cached is not None:
+            objective, solver_duration, assignment = cached
+            assert (len(assignment) == len(tasks) and check_assignment(compat, assignment))
+            duration = time.time() - start
+        else:
+            objective, solver_duration, assignment = self.problem.optimize(tasks, agents, profits, directory,
+                                                                           filename=filename)
+            self.cache.put(key, objective, solver_duration, assignment, solver=solver,
+                           optimal=getattr(self.problem, 'optimal', False), timeout=self.timeout)
+            duration = time.time() - start
+
+        print('Solution cache: Hit: %s / Hits: %d / Misses: %d / Solver time: %.2f / Time: %.3f' % (
+            cached is not None, self.cache.hits, self.cache.misses, solver_duration, duration))
+
+        return int(objective), duration, np.asarray(assignment, dtype=int)
+
+    @property
+    def solved_by(self):
+        return 'cache' if self.hit else super().solved_by
+
+
+def race(problem, index, results, tasks, agents, profits, directory, filename):
+    # Own process group, so that external solvers started by the backend are killed with it
+    os.setsid()
+
+    try:
+        objective, duration, assignment = problem.optimize(tasks, agents, profits, directory, filename=filename)
+        results.put((index, objective, duration, np.asarray(assignment, dtype=int), getattr(problem, 'optimal', False)))
+    except Exception as e:
+        print('Portfolio: %s failed: %r' % (problem, e))
+        results.put((index, None, None, None, False))
+
+
+class Portfolio(object):
+    """
+    Races the backends `problems` on each cycle, each in its own process. Returns the first solution proven optimal
+    (within the gap of its backend), otherwise the best solution available at the timeout, and kills the other
+    backends. Backends get `grace` seconds beyond the timeout to return their solution. The winner of the last cycle
+    is `solved_by`, winners are counted per backend and logged with each cycle.
+    """
+
+    def __init__(self, problems, timeout=60, grace=1):
+        self.problems = problems
+        self.grace = grace
+        self.wins = Counter()
+        self.solved_by = None
+        self.optimal = False
+        self.timeout = timeout
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+
+        for problem in self.problems:
+            problem.timeout = timeout
+
+    def optimize(self, tasks, agents, profits, directory, filename=None):
+        start = time.time()
+        _, _, _, compat = cycle_matrices(agents, tasks)
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        processes = []
+
+        # Forked processes would write the buffered output again
+        sys.stdout.flush()
+
+        for i, problem in enumerate(self.problems):
+            problem_filename = filename.replace('_in.pl', '_%s%d_in.pl' % (problem, i)) if filename else None
+            process = context.Process(target=race, args=(problem, i, results, tasks, agents, profits, directory,
+                                                         problem_filename))
+            process.start()
+            processes.append(process)
+
+        deadline = start + self.timeout + self.grace
+        solutions = {}
+        winner = None
+
+        while len(solutions) < len(processes):
+            try:
+                i, objective, duration, assignment, optimal = results.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+
+            solutions[i] = (objective, duration, assignment, optimal)
+
+            if objective is not None and (winner is None or objective > solutions[winner][0] or optimal):
+                winner = i
+
+            if optimal:
+                break
+
+        for process in processes:
+            if process.is_alive():
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    # Killed before it got its own process group, so it has not started any solver yet
+                    process.kill()
+
+            process.join()
+
+        results.close()
+
+        if winner is None:
+            objective, assignment, optimal = 0, np.zeros(len(tasks), dtype=int), False
+        else:
+            objective, _, assignment, optimal = solutions[winner]
+            self.wins[str(self.problems[winner])] += 1
+
+        self.solved_by = str(self.problems[winner]) if winner is not None else None
+        self.optimal = optimal
+
+        assert (check_assignment(compat, assignment))
+
+        duration = time.time() - start
+        report = []
+
+        for i, problem in enumerate(self.problems):
+            if i not in solutions:
+                report.append('%s: killed' % problem)
+            elif solutions[i][0] is None:
+                report.append('%s: failed' % problem)
             else:
-                assignments[agent_name] = [task_name]
+                report.append('%s: %d (%.2f s%s)' % (problem, solutions[i][0], solutions[i][1],
+                                                     ', optimal' if solutions[i][3] else ''))
 
-        return int(objective), duration, assignments
+        print('Portfolio: Winner: %s / Objective: %d / Optimal: %s / Time: %.2f / %s / Wins: %s' % (
+            self.problems[winner] if winner is not None else None, objective, optimal, duration, ', '.join(report),
+            ', '.join('%s %d' % win for win in self.wins.most_common())))
+
+        return int(objective), duration, assignment
 
     def __str__(self):
-        return 'mulknap'
+        return 'portfolio'
 
 
 class MinizincSolver(pymzn.Solver):
@@ -203,7 +995,7 @@ class MinizincSolver(pymzn.Solver):
         self.solver = solver
 
     def args(self, mzn_file, *dzn_files, data=None, timeout=None, all_solutions=False, num_solutions=None,
-             output_mode='item', parallel=1, seed=0, statistics=False, **kwargs):
+             output_mode='item', parallel=1, seed=0, statistics=False, rel_gap=None, **kwargs):
         """Returns the command line arguments to start the solver"""
         args = ['minizinc', '--solver', self.solver, '--output-objective']
 
@@ -216,6 +1008,9 @@ class MinizincSolver(pymzn.Solver):
                 args.append(dzn_file)
 
         if timeout:
-            args.extend(['--time-limit', str(timeout * 1000)])
+            args.extend(['--time-limit', str(int(timeout * 1000))])
+
+        if rel_gap:
+            args.extend(['--relGap', str(rel_gap)])
 
         return args
@@ -0,0 +1,153 @@
+"""
+On-disk cache of cycle solutions, shared by all runs on one machine.
+
+Entries are keyed by a hash of the canonical cycle input (see `cycle_key`) and stored in the binary format of
+`instance_cache`, one file per entry with the objective and solver metadata in the header. Entries are written
+atomically, so concurrent runs never read partial entries. The cache is bounded in size: the modification time of an
+entry is its last use, and the least recently used entries are evicted once the size shared by all runs exceeds the
+bound.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+import instance_cache
+
+__all__ = ['SUFFIX', 'cycle_key', 'SolutionCache']
+
+SUFFIX = '.sol'
+LOCK_FILE = '.lock'
+EVICT_RATIO = 0.9
+
+
+def cycle_key(solver, capacities, weight_mat, values, compat):
+    """ Hash of the cycle input, ints and floats are canonicalized to 64 bit so that dtypes do not split entries """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(solver.encode('utf-8'))
+
+    for a in (capacities, weight_mat, values, compat):
+        a = np.asarray(a)
+        a = a.astype(np.float64 if a.dtype.kind == 'f' else np.int64)
+        h.update(json.dumps([a.dtype.str, a.shape]).encode('utf-8'))
+        h.update(np.ascontiguousarray(a).tobytes())
+
+    return h.hexdigest()
+
+
+class SolutionCache(object):
+    def __init__(self, directory, max_size=1 << 30):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + SUFFIX)
+
+    def get(self, key, timeout=None):
+        """
+        Returns objective, original duration and assignment of the entry and marks it as used, None if missing.
+        Solutions not proven optimal are only returned if they were found within the same `timeout`.
+        """
+        path = self.path(key)
+
+        try:
+            header, _ = instance_cache.read_header(path)
+            info = header['source']
+
+            if not (info['optimal'] or info['timeout'] == timeout):
+                raise KeyError('timeout')
+
+            assignment = np.array(instance_cache.read(path)['assignment'], dtype=int)
+            os.utime(path)
+        except (OSError, ValueError, KeyError, struct.error):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return info['objective'], info['duration'], assignment
+
+    def put(self, key, objective, duration, assignment, solver=None, optimal=False, timeout=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+
+        try:
+            instance_cache.write(path, {'assignment': np.asarray(assignment, dtype=int)},
+                                 source={'objective': int(objective), 'duration': duration, 'solver': solver,
+                                         'optimal': bool(optimal), 'timeout': timeout})
+            entry_size = os.path.getsize(path)
+        except OSError:
+            return
+
+        # The total size is shared by all runs, kept in the lock file and rescanned at each eviction. An entry
+        # replacing one of the same key only adds the difference.
+        with open(os.path.join(self.directory, LOCK_FILE), 'a+') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            lock.seek(0)
+
+            try:
+                size = int(lock.read()) + entry_size - old_size
+            except ValueError:
+                size = self.disk_size()
+
+            if size > self.max_size:
+                size = self.evict()
+
+            lock.seek(0)
+            lock.truncate()
+            lock.write(str(size))
+
+    def entries(self):
+        """ Path, size and last use of all entries, entries removed by other runs meanwhile are skipped """
+        entries = []
+
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(SUFFIX):
+                    continue
+
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+
+        return entries
+
+    def disk_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """ Removes the least recently used entries down to a fraction of the maximum size, returns the size left """
+        entries = sorted(self.entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+
+        for _, entry_size, path in entries:
+            if size <= self.max_size * EVICT_RATIO:
+                break
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+            size -= entry_size
+
+        return size
@@ -1,38 +1,46 @@
+import heapq
 import time
+from abc import ABC, abstractmethod
 
 import numpy as np
-import pymzn
 
-from function import affinity_pressure, matrizes
+import exchange_solver
+from function import CycleIndex, affinity_pressure, check_assignment, cycle_matrices, matrizes, split_values
 
 
-class Strategy(object):
+class Strategy(ABC):
+    """
+    Strategies turn the dense profit and affinity matrices of a cycle (tasks x available agents, 0 for incompatible
+    pairs) into the values the problem maximizes, see `values`. `profits` is the former interface and returns the
+    values of each task towards its available agents as one array per task.
+    """
+
+    @abstractmethod
+    def values(self, profits, affinities, compat):
+        """ Dense tasks x agents values, 0 for incompatible pairs """
+
+    def cycle_values(self, tasks, agents):
+        profits, affinities, _, compat = CycleIndex.of(tasks, agents).matrices()
+        return self.values(profits, affinities, compat)
+
     def profits(self, tasks, agents):
-        pass
+        _, _, _, compat = CycleIndex.of(tasks, agents).matrices()
+        return split_values(compat, self.cycle_values(tasks, agents))
 
     def mode(self):
         return ''
 
-    def exchange(self, agents, tasks, profits, initial_assignments, objective):
-        return initial_assignments, objective
+    def exchange(self, agents, tasks, profits, initial_assignment, objective):
+        """ Takes and returns the assignment vector: agent index + 1 of each task, 0 if unassigned """
+        return initial_assignment, objective
 
     @staticmethod
     def profits_and_affs(tasks, agents):
-        profits = []
-        affinities = []
-
-        for t in tasks:
-            tprio, taffs = zip(
-                *[(t.profits[x.name], t.affinities[x.name]) for x in agents if x.name in t.profits.keys()])
-            profits.append(np.array(tprio))
-            affinities.append(np.array(taffs))
-
-        return profits, affinities
+        return CycleIndex.of(tasks, agents).task_values()
 
 
 class ProfitStrategy(Strategy):
-    def profits(self, tasks, agents):
-        profits, affinities = self.profits_and_affs(tasks, agents)
+    def values(self, profits, affinities, compat):
         return profits
 
     def __str__(self):
@@ -40,8 +48,7 @@ class ProfitStrategy(Strategy):
 
 
 class AffinityStrategy(Strategy):
-    def profits(self, tasks, agents):
-        _, affinities = self.profits_and_affs(tasks, agents)
+    def values(self, profits, affinities, compat):
         return affinities
 
     def __str__(self):
@@ -53,10 +60,12 @@ class SwitchAtThresholdStrategy(Strategy):
         self.threshold = threshold
         self.pp = 1
 
-    def profits(self, tasks, agents):
-        profits, affinities = self.profits_and_affs(tasks, agents)
+    def cycle_values(self, tasks, agents):
+        # The pressure considers all available agents, including restricted ones
         self.pp = affinity_pressure(tasks, agents)
+        return super().cycle_values(tasks, agents)
 
+    def values(self, profits, affinities, compat):
         if self.pp < self.threshold:
             return profits
         else:
@@ -73,11 +82,8 @@ class SwitchAtThresholdStrategy(Strategy):
 
 
 class ProductCombinationStrategy(Strategy):
-    def profits(self, tasks, agents):
-        profits, affinities = self.profits_and_affs(tasks, agents)
-
-        profits = [prio * aff for (prio, aff) in zip(profits, affinities)]
-        return profits
+    def values(self, profits, affinities, compat):
+        return profits * affinities
 
     def __str__(self):
         return 'productcomb'
@@ -88,39 +94,39 @@ class WeightedPartialProfits(Strategy):
         self.individual_weights = individual_weights
         self.weights = []
 
-    def profits(self, tasks, agents):
-        profits, affinities = self.profits_and_affs(tasks, agents)
-
-        prio_max = np.max([p.max() for p in profits])
-        aff_max = np.max([a.max() for a in affinities])
+    def cycle_values(self, tasks, agents):
+        index = CycleIndex.of(tasks, agents)
+        profits, affinities, _, compat = index.matrices()
 
-        self.weights = []
+        # Ideal and actual affinity sums consider all available agents, including restricted ones
+        affinity_sums, nb_agents = index.table.affinity_sums(index.rows, index.cols)
 
-        if not self.individual_weights:
-            ideal_sum = np.sum([t.ideal_affinity_sum(agents) for t in tasks])
-            actual_sum = np.sum([t.affinity_sum(agents) for t in tasks])
-            weight = ideal_sum / actual_sum
-            weight = np.minimum(weight, 1)
-            self.weights.append(weight)
+        return self.values(profits, affinities, compat, affinity_sums, nb_agents)
 
-        values = []
+    def values(self, profits, affinities, compat, affinity_sums=None, nb_agents=None):
+        if affinity_sums is None:
+            affinity_sums, nb_agents = affinities.sum(axis=1), compat.sum(axis=1)
 
-        for (t, prio, aff) in zip(tasks, profits, affinities):
-            aff *= np.min(aff[aff > 0])
+        ideal_sums = nb_agents * (nb_agents + 1) / 2
+        prio_max = profits.max()
+        aff_max = affinities.max()
 
-            if self.individual_weights:
-                weight = t.ideal_affinity_sum(agents) / np.sum(aff[aff > 0])  # t.affinity_sum(agents)
-                weight = min(weight, 1)
-                self.weights.append(weight)
+        affinities = affinities * np.min(affinities, axis=1, keepdims=True, initial=aff_max, where=compat)
 
-            p = (weight * prio / prio_max + (1 - weight) * aff / aff_max) * 1000
+        if self.individual_weights:
+            weights = np.minimum(ideal_sums / affinities.sum(axis=1), 1)
+            weight = weights[:, np.newaxis]
+        else:
+            weight = np.minimum(ideal_sums.sum() / affinity_sums.sum(), 1)
+            weights = [weight]
 
-            assert (0 <= weight <= 1)
-            assert (np.all(p > 0))
+        self.weights = list(weights)
+        values = (weight * profits / prio_max + (1 - weight) * affinities / aff_max) * 1000
 
-            values.append(p.astype(int))
+        assert (np.all((0 <= weight) & (weight <= 1)))
+        assert (np.all(values[compat] > 0))
 
-        return values
+        return values.astype(int)
 
     def mode(self):
         return np.mean(self.weights).round(decimals=3)
@@ -136,34 +142,31 @@ class LimitedAssignment(Strategy):
     def __init__(self, core_strategy):
         self.core_strategy = core_strategy
 
-    def profits(self, tasks, agents):
-        for t in tasks:
-            if len(t.poss_agents) <= 1 or len(t.history) == 0:
-                # We do not remove tasks by limited assignment
-                continue
-
-            possible_assignments = [(x.name, t.affinities[x.name]) for x in agents if x.name in t.poss_agents]
-            possible_assignments.sort(key=lambda x: x[1])
-
-            if len(possible_assignments) < 2:
-                # Must have at least one possible assignment left
-                continue
+    def cycle_values(self, tasks, agents):
+        index = CycleIndex.of(tasks, agents)
+        _, affinities, _, available = index.matrices()
+        table = index.table
 
-            mean_aff = np.floor(np.mean([k[1] for k in possible_assignments]))
+        # We do not remove tasks by limited assignment, and at least one possible assignment must be left
+        nb_poss_agents = (table.compat[index.rows] & ~table.restricted[index.rows]).sum(axis=1)
+        nb_available = available.sum(axis=1)
+        limited = (nb_poss_agents > 1) & (table.assignment_counts[index.rows] > 0) & (nb_available >= 2)
 
-            for name, aff in possible_assignments:
-                if aff < mean_aff:
-                    t.restrict_agent(name)
+        mean_affs = np.floor(affinities.sum(axis=1) / np.maximum(nb_available, 1))
+        index.restrict(available & limited[:, np.newaxis] & (affinities < mean_affs[:, np.newaxis]))
 
-            # TODO Alternative formulations: < median(affinity), < mean(affinity)
-            # Mean probably better as it captures outliers, median likely to cut in half
-            # name_to_remove = min(possible_assignments, key=lambda k: k[1])[0]
+        # TODO Alternative formulations: < median(affinity), < mean(affinity)
+        # Mean probably better as it captures outliers, median likely to cut in half
+        # name_to_remove = min(possible_assignments, key=lambda k: k[1])[0]
 
         # Fetch updated profits + affinities from core strategy
-        values = self.core_strategy.profits(tasks, agents)
+        values = self.core_strategy.cycle_values(tasks, agents)
 
         return values
 
+    def values(self, profits, affinities, compat):
+        return self.core_strategy.values(profits, affinities, compat)
+
     def __str__(self):
         return str(self.core_strategy) + '-limit'
 
@@ -172,118 +175,113 @@ class Negotiation(ProfitStrategy):
     def __init__(self, acceptance_ratio=0.6):
         self.acceptance_ratio = acceptance_ratio
 
-    def assignment_matrix(self, agents, tasks, assignments):
-        all_assigned = []
-        task_pos = [t.name for t in tasks]
-        x = np.zeros((len(tasks), len(agents) + 1), dtype=bool)
-
-        for col_idx, agent_key in enumerate(sorted(assignments), start=1):
-            assigned_tasks = assignments[agent_key]
+    @staticmethod
+    def candidate_blocks(assignment, aff_improv, prof_diff, profit_matrix, first_source_agent=1):
+        """
+        Exchanges of a task of a source agent against a task of a destination agent, which improve the welfare.
+        Source agent 0 offers the unassigned tasks.
+        Returns one block per pair of agents with candidates, sorted by the merge key:
+        (-welfare improvement, profit change, source agent, rank of the dest. task, source tasks, destination agent,
+        dest. tasks), followed by the source and dest. tasks as arrays.
+        """
+        blocks = []
 
-            for t in assigned_tasks:
-                row_idx = task_pos.index(t)
-                x[row_idx, col_idx] = 1
+        for source_agent in range(first_source_agent, aff_improv.shape[1]):
+            affimp = aff_improv[:, source_agent]
 
-            all_assigned.extend(assigned_tasks)
+            # Destination tasks in the order they were originally generated, by rank
+            dest_tasks = np.flatnonzero(affimp > 0)
+            dest_tasks = dest_tasks[np.argsort(affimp[dest_tasks][::-1])]
+            dest_agents = assignment[dest_tasks]
+            source_tasks = np.flatnonzero(assignment == source_agent)
 
-        unassigned = set([t.name for t in tasks]) - set(all_assigned)
+            for dest_agent in np.unique(dest_agents[dest_agents > 0]).tolist():
+                ranks = np.flatnonzero(dest_agents == dest_agent)
+                offered = source_tasks[profit_matrix[source_tasks, dest_agent] > 0]
 
-        for t in unassigned:
-            row_idx = task_pos.index(t)
-            x[row_idx, 0] = 1
+                welfare = aff_improv[offered, dest_agent][:, np.newaxis] + affimp[dest_tasks[ranks]]
+                sources, dests = np.nonzero(welfare > 0)
 
-        return x
+                if len(sources) == 0:
+                    continue
 
-    def assignment_mat_to_dict(self, agents, tasks, x):
-        new_assignments = {}
+                welfare = welfare[sources, dests]
+                ranks = ranks[dests]
+                sources = offered[sources]
+                dests = dest_tasks[ranks]
+                profit_change = prof_diff[dests, source_agent] + prof_diff[sources, dest_agent]
 
-        for agent_idx, column in enumerate(x[:, 1:].T):
-            assigned_rows = np.where(column == 1)[0]
-            assigned_tasks = [tasks[r].name for r in assigned_rows]
-            assert (all(agents[agent_idx].name in tasks[r].poss_agents for r in assigned_rows))
-            new_assignments[agents[agent_idx].name] = assigned_tasks
+                order = np.lexsort((sources, ranks, profit_change, -welfare))
+                blocks.append(((-welfare[order]).tolist(), profit_change[order].tolist(), source_agent,
+                               ranks[order].tolist(), sources[order].tolist(), dest_agent, dests[order].tolist(),
+                               sources[order], dests[order]))
 
-        return new_assignments
+        return blocks
 
 
 class OneSwapNegotiation(Negotiation):
-    def exchange(self, agents, tasks, profits, initial_assignments, objective):
+    def exchange(self, agents, tasks, profits, initial_assignment, objective):
         min_objective = int(objective * self.acceptance_ratio)
 
         print('Objective: %d / Bound: %d' % (objective, min_objective))
 
-        candidates = []
-        capacities = [0] + [a.capacity for a in agents]
+        capacities = np.array([0] + [a.capacity for a in agents])
 
         profit_matrix, aff_mat, weight_matrix = matrizes(agents, tasks, pad_dummy_agent=True)
-        x = self.assignment_matrix(agents, tasks, initial_assignments)
-
-        initial_affinities = np.sum(aff_mat * x, axis=1, keepdims=True)
-        initial_profits = np.sum(profit_matrix * x, axis=1, keepdims=True)
-
-        aff_improv = (aff_mat - initial_affinities) * (aff_mat > 0)
-        aff_improv[:, [0]] -= initial_affinities
-
-        prof_diff = (profit_matrix - initial_profits) * (profit_matrix > 0)
-        prof_diff[:, [0]] -= initial_profits
+        assignment = np.array(initial_assignment, dtype=int)
+        task_ids = np.arange(len(tasks))
 
-        # 1. Build a list of all potential, welfare-improving exchanges
-        for source_agent, affimp in enumerate(aff_improv.T):
-            if source_agent == 0:
-                continue  # Don't initiate from non-assigned
+        initial_affinities = aff_mat[task_ids, assignment]
+        initial_profits = profit_matrix[task_ids, assignment]
 
-            pot_gains = affimp[affimp > 0]
-            task_ids = np.where(affimp > 0)[0]  # row id
-            sorted_order = np.argsort(affimp[affimp > 0][::-1])
+        aff_improv = (aff_mat - initial_affinities[:, np.newaxis]) * (aff_mat > 0)
+        aff_improv[:, 0] -= initial_affinities
 
-            pot_gains = pot_gains[sorted_order]
-            task_ids = task_ids[sorted_order]
+        prof_diff = (profit_matrix - initial_profits[:, np.newaxis]) * (profit_matrix > 0)
+        prof_diff[:, 0] -= initial_profits
 
-            for dest_task, my_pot_gain in zip(task_ids, pot_gains):
-                dest_agent = np.where(x[dest_task, :])[0][0]  # column id
+        # 1. Build all potential, welfare-improving exchanges, as one block per source and destination agent
+        blocks = self.candidate_blocks(assignment, aff_improv, prof_diff, profit_matrix)
+        nb_candidates = sum(len(b[0]) for b in blocks)
 
-                source_offerings = x[:, source_agent]
-                dest_demand = aff_improv[:, dest_agent] > -my_pot_gain
-                dest_compatible = profit_matrix[:, dest_agent] > 0  # Could also be aff_mat or weight_matrix
-                potential_exchanges = np.logical_and(source_offerings, dest_demand)
-                potential_exchanges = np.logical_and(potential_exchanges, dest_compatible)
+        print('Tasks: %d / Candidates: %d' % (len(tasks), nb_candidates))
 
-                for source_task in np.where(potential_exchanges)[0]:
-                    welfare_improv = my_pot_gain + aff_improv[source_task, dest_agent]
-                    profit_change = prof_diff[dest_task, source_agent] + prof_diff[source_task, dest_agent]
+        # 2. Merge the blocks by 1) potential welfare improvement and 2) least profit decrease,
+        # ties are taken in the order of the candidate generation.
+        # Candidates of already exchanged tasks are skipped within their block, without passing the queue
+        exchanged = bytearray(len(tasks))
+        heap = [self.heap_entry(b, i, 0) for i, b in enumerate(blocks)]
+        heapq.heapify(heap)
 
-                    assert (x[source_task, source_agent])
-                    assert (x[dest_task, dest_agent])
-                    assert (welfare_improv >= 0)
+        # Per-agent loads, kept up to date with each exchange; Python lists for fast scalar access
+        loads = np.zeros(len(agents) + 1, dtype=int)
+        np.add.at(loads, assignment, weight_matrix[task_ids, assignment])
+        loads, caps, weights = loads.tolist(), capacities.tolist(), weight_matrix.tolist()
+        nb_exchanged = 0
 
-                    candidates.append((source_agent, source_task, dest_agent, dest_task, welfare_improv, profit_change))
-
-        print('Tasks: %d / Candidates: %d' % (len(tasks), len(candidates)))
-
-        # 2 Sort by 1) potential welfare improvement and 2) least profit decrease
-        candidates.sort(key=lambda x: (-x[4], x[5]))
-
-        exchanged_tasks = set()
-        applied_exchanges = []
-
-        already_exchanged = 0
         objective_bound = 0
         weight_problem = 0
 
         # 3. Greedily apply exchanges (this could be solved as CP/SAT or simply as a multi-pass heuristic)
         # But as long as the weight-barrier is the main failure reason, another heuristic will not help
-        for (source_agent, source_task, dest_agent, dest_task, welfare_improv, profit_change) in candidates:
-            if source_task in exchanged_tasks or dest_task in exchanged_tasks:
-                already_exchanged += 1
+        while heap:
+            neg_welfare, profit_change, source_agent, _, source_task, block_id, pos = heapq.heappop(heap)
+            block = blocks[block_id]
+            dest_agent, dest_task = block[5], block[6][pos]
+
+            if exchanged[source_task] or exchanged[dest_task]:
+                # Exchanged since the candidate was queued
+                self.queue_next(heap, block, block_id, pos, exchanged)
                 continue
 
-            cur_weights = np.sum(weight_matrix * x, axis=0)
-            new_source_weight = cur_weights[source_agent] - weight_matrix[source_task, source_agent] + weight_matrix[
-                dest_task, source_agent]
-            new_dest_weight = cur_weights[dest_agent] - weight_matrix[dest_task, dest_agent] + weight_matrix[
-                source_task, dest_agent]
+            self.queue_next(heap, block, block_id, pos + 1, exchanged)
+
+            new_source_weight = (loads[source_agent] - weights[source_task][source_agent] +
+                                 weights[dest_task][source_agent])
+            new_dest_weight = (loads[dest_agent] - weights[dest_task][dest_agent] +
+                               weights[source_task][dest_agent])
 
-            if new_source_weight > capacities[source_agent] or new_dest_weight > capacities[dest_agent]:
+            if new_source_weight > caps[source_agent] or new_dest_weight > caps[dest_agent]:
                 weight_problem += 1
                 continue
 
@@ -291,183 +289,287 @@ class OneSwapNegotiation(Negotiation):
                 objective_bound += 1
                 continue
 
-            assert (x[source_task, source_agent])
-            assert (x[dest_task, dest_agent])
-            assert (not x[dest_task, source_agent])
-            assert (not x[source_task, dest_agent])
+            assert (assignment[source_task] == source_agent)
+            assert (assignment[dest_task] == dest_agent)
 
-            x[source_task, source_agent] = 0
-            x[source_task, dest_agent] = 1
-            x[dest_task, dest_agent] = 0
-            x[dest_task, source_agent] = 1
+            assignment[source_task] = dest_agent
+            assignment[dest_task] = source_agent
+            loads[source_agent] = new_source_weight
+            loads[dest_agent] = new_dest_weight
 
-            exchanged_tasks.add(source_task)
-            exchanged_tasks.add(dest_task)
-            applied_exchanges.append((source_agent, source_task, dest_agent, dest_task, welfare_improv, profit_change))
+            exchanged[source_task] = exchanged[dest_task] = 1
+            nb_exchanged += 1
 
-        new_assignments = self.assignment_mat_to_dict(agents, tasks, x)
-        new_objective = np.sum(profit_matrix * x)
+        already_exchanged = nb_candidates - nb_exchanged - weight_problem - objective_bound
 
-        assert (np.all(np.count_nonzero(x, axis=1) == 1))
-        assert (np.all(np.sum(weight_matrix * x, axis=0) <= capacities))
+        new_affinities = aff_mat[task_ids, assignment]
+        new_objective = profit_matrix[task_ids, assignment].sum()
+
+        _, _, _, compat = cycle_matrices(agents, tasks)
+        assert (check_assignment(compat, assignment))
+        assert (np.all(np.array(loads) <= capacities))
         assert (new_objective >= min_objective)
 
-        aff_improvement = np.sum(aff_mat * x) - np.sum(initial_affinities)
-        aff_imp_perc = np.sum(aff_mat * x) / np.sum(initial_affinities) - 1.0
+        aff_improvement = np.sum(new_affinities) - np.sum(initial_affinities)
+        aff_imp_perc = np.sum(new_affinities) / np.sum(initial_affinities) - 1.0
         objective_decrease = new_objective - objective
         print('Failure reason: Already exchanged: %d / Objective: %d / Weight: %d' % (
             already_exchanged, objective_bound, weight_problem))
         print('Changes occurred: %d / Aff. Improved: %d (%.2f) / Objective decreased: %d' % (
-            len(exchanged_tasks) / 2, aff_improvement, aff_imp_perc, objective_decrease))
+            nb_exchanged, aff_improvement, aff_imp_perc, objective_decrease))
+
+        return assignment, new_objective
+
+    @staticmethod
+    def heap_entry(block, block_id, pos):
+        neg_welfare, profit_change, source_agent, ranks, sources = block[:5]
+        return neg_welfare[pos], profit_change[pos], source_agent, ranks[pos], sources[pos], block_id, pos
+
+    @classmethod
+    def queue_next(cls, heap, block, block_id, pos, exchanged, scan=16, chunk=256):
+        """
+        Queues the next candidate of the block from `pos` on, whose tasks were not exchanged yet.
+        `exchanged` is a bytearray, the first candidates are checked directly, the rest in chunks.
+        """
+        sources, dests = block[4], block[6]
+        end = min(pos + scan, len(sources))
+
+        while pos < end:
+            if not (exchanged[sources[pos]] or exchanged[dests[pos]]):
+                heapq.heappush(heap, cls.heap_entry(block, block_id, pos))
+                return
+
+            pos += 1
+
+        flags = np.frombuffer(exchanged, dtype=bool)
+        sources, dests = block[7], block[8]
+
+        while pos < len(sources):
+            alive = np.flatnonzero(~(flags[sources[pos:pos + chunk]] | flags[dests[pos:pos + chunk]]))
+
+            if len(alive) > 0:
+                heapq.heappush(heap, cls.heap_entry(block, block_id, pos + int(alive[0])))
+                return
 
-        return new_assignments, new_objective
+            pos += chunk
 
     def __str__(self):
         return 'oneswap%d' % int(self.acceptance_ratio * 100)
 
 
 class SolverNegotiation(Negotiation):
-    def exchange(self, agents, tasks, profits, initial_assignments, objective):
+    def __init__(self, acceptance_ratio=0.6, timeout=1):
+        super().__init__(acceptance_ratio)
+        self.timeout = timeout
+
+    def exchange(self, agents, tasks, profits, initial_assignment, objective):
         min_objective = int(objective * self.acceptance_ratio)
 
         print('Objective: %d / Bound: %d' % (objective, min_objective))
 
-        candidates = set()
-        capacities = [0] + [a.capacity for a in agents]
+        capacities = np.array([0] + [a.capacity for a in agents])
 
         profit_matrix, aff_mat, weight_matrix = matrizes(agents, tasks, pad_dummy_agent=True)
-        x = self.assignment_matrix(agents, tasks, initial_assignments)
-
-        initial_affinities = np.sum(aff_mat * x, axis=1, keepdims=True)
-        initial_profits = np.sum(profit_matrix * x, axis=1, keepdims=True)
-
-        aff_improv = (aff_mat - initial_affinities) * (aff_mat > 0)
-        aff_improv[:, [0]] -= initial_affinities
-        prof_diff = (profit_matrix - initial_profits) * (profit_matrix > 0)
-        prof_diff[:, [0]] -= initial_profits
-
-        delta_welfares = []
-        delta_profits = []
-        delta_weights = []
-        affected_agents = []
-        exchanged_tasks = []
-
-        # 1. Build a list of all potential, welfare-improving exchanges
-        for source_agent, affimp in enumerate(aff_improv.T):
-            # if source_agent == 0:
-            #    continue  # Don't initiate from non-assigned
-
-            pot_gains = affimp[affimp > 0]
-            task_ids = np.where(affimp > 0)[0]  # row id
-            sorted_order = np.argsort(affimp[affimp > 0][::-1])
-
-            pot_gains = pot_gains[sorted_order]
-            task_ids = task_ids[sorted_order]
-
-            for dest_task, my_pot_gain in zip(task_ids, pot_gains):
-                dest_agent = np.where(x[dest_task, :])[0][0]  # column id
-
-                source_offerings = x[:, source_agent]
-                dest_demand = aff_improv[:, dest_agent] > -my_pot_gain
-                dest_compatible = profit_matrix[:, dest_agent] > 0  # Could also be aff_mat or weight_matrix
-                potential_exchanges = np.logical_and(source_offerings, dest_demand)
-                potential_exchanges = np.logical_and(potential_exchanges, dest_compatible)
-
-                for source_task in np.where(potential_exchanges)[0]:
-                    welfare_improv = my_pot_gain + aff_improv[source_task, dest_agent]
-                    profit_change = prof_diff[dest_task, source_agent] + prof_diff[source_task, dest_agent]
-
-                    assert (x[source_task, source_agent])
-                    assert (x[dest_task, dest_agent])
-                    assert (welfare_improv >= 0)
-                    assert (welfare_improv == aff_improv[source_task, dest_agent] + aff_improv[dest_task, source_agent])
-
-                    ex1 = (source_agent, source_task, dest_agent, aff_improv[source_task, dest_agent],
-                           prof_diff[source_task, dest_agent],
-                           (-weight_matrix[source_task, source_agent], weight_matrix[source_task, dest_agent]))
-                    ex2 = (dest_agent, dest_task, source_agent, aff_improv[dest_task, source_agent],
-                           prof_diff[dest_task, source_agent],
-                           (-weight_matrix[dest_task, dest_agent], weight_matrix[dest_task, source_agent]))
-                    candidates.add(((-welfare_improv, -profit_change), ex1, ex2))
-
-        for _, ex1, ex2 in sorted(candidates, key=lambda trans: trans[0]):
-            delta_welfares.append(ex1[3])
-            delta_welfares.append(ex2[3])
-
-            delta_profits.append(ex1[4])
-            delta_profits.append(ex2[4])
-
-            delta_weights.append(list(ex1[5]))
-            delta_weights.append(list(ex2[5]))
-
-            affected_agents.append([source_agent + 1, dest_agent + 1])
-            affected_agents.append([dest_agent + 1, source_agent + 1])
-
-            exchanged_tasks.append(source_task)
-            exchanged_tasks.append(dest_task)
-
-        weight_budget = np.array(capacities) - np.sum(weight_matrix * x, axis=0)
-
-        assert (len(delta_welfares) == len(candidates) * 2)
-        assert (len(weight_budget) == len(agents) + 1)
-
-        data = {
-            'n_agents': len(agents) + 1,
-            'n_tasks': len(tasks),
-            'n_exchanges': len(delta_welfares),
-            'profit_budget': objective - min_objective,
-            'weight_budget': weight_budget,
-            'delta_welfares': delta_welfares,
-            'delta_profits': delta_profits,
-            'delta_weights': delta_weights,
-            'agents': affected_agents,
-            'task_ids': exchanged_tasks
-        }
-
-        print('Exchanges: %d' % len(delta_welfares))
-
-        if len(delta_welfares) > 0:
-            pymzn.dict2dzn(data, fout='neg1.dzn')
-            start = time.time()
-            output = pymzn.minizinc('negotiation.mzn', solver='gecode', data=data, timeout=30)  # Not a MIP problem
-            duration = time.time() - start
-
-            sel_exchanges = output[0]['assignment']
-            affinity_improvement = output[0]['objective']
-            nb_exchanges = np.count_nonzero(sel_exchanges)
-
-            print('Applied Exchanges: %d / Improvement: %d / Time: %d' % (nb_exchanges, affinity_improvement, duration))
-
-            if nb_exchanges == 0:
-                return initial_assignments, objective
-
-            for ex_id in np.where(sel_exchanges)[0]:
-                task_id = exchanged_tasks[ex_id]
-                source_agent, dest_agent = affected_agents[ex_id]
-                source_agent, dest_agent = source_agent - 1, dest_agent - 1
-
-                assert (x[task_id, source_agent])
-                assert (not x[task_id, dest_agent])
-
-                x[task_id, source_agent] = 0
-                x[task_id, dest_agent] = 1
+        assignment = np.array(initial_assignment, dtype=int)
+        task_ids = np.arange(len(tasks))
 
-            new_assignments = self.assignment_mat_to_dict(agents, tasks, x)
-            new_objective = np.sum(profit_matrix * x)
+        initial_affinities = aff_mat[task_ids, assignment]
+        initial_profits = profit_matrix[task_ids, assignment]
 
-            assert (np.sum(aff_mat * x) == (np.sum(initial_affinities) + affinity_improvement))
-            assert (np.all(np.count_nonzero(x, axis=1) == 1))
-            assert (np.all(np.sum(weight_matrix * x, axis=0) <= capacities))
-            assert (new_objective >= min_objective)
+        aff_improv = (aff_mat - initial_affinities[:, np.newaxis]) * (aff_mat > 0)
+        aff_improv[:, 0] -= initial_affinities
+        prof_diff = (profit_matrix - initial_profits[:, np.newaxis]) * (profit_matrix > 0)
+        prof_diff[:, 0] -= initial_profits
 
-            return new_assignments, new_objective
-        else:
-            return initial_assignments, objective
+        # 1. Build all potential, welfare-improving exchanges. Each exchange moves two tasks, the solver selects
+        # single moves of any exchange, so every distinct move (task, destination agent) is one item
+        blocks = self.candidate_blocks(assignment, aff_improv, prof_diff, profit_matrix, first_source_agent=0)
+        n_agents = len(agents) + 1
+
+        if len(blocks) == 0:
+            print('Exchanges: 0')
+            return initial_assignment, objective
+
+        moves = np.concatenate([np.stack((b[7] * n_agents + b[5], b[8] * n_agents + b[2]), axis=1) for b in blocks])
+        moves, pairs = np.unique(moves, return_inverse=True)
+        pairs = pairs.reshape((-1, 2))
+        move_tasks, dest_agents = np.divmod(moves, n_agents)
+        source_agents = assignment[move_tasks]
+
+        # Constraints: profit decrease within the budget, agent loads within the capacities
+        weights = np.zeros((n_agents + 1, len(moves)), dtype=int)
+        weights[0] = -prof_diff[move_tasks, dest_agents]
+        np.add.at(weights, (source_agents + 1, np.arange(len(moves))), -weight_matrix[move_tasks, source_agents])
+        np.add.at(weights, (dest_agents + 1, np.arange(len(moves))), weight_matrix[move_tasks, dest_agents])
+
+        loads = np.bincount(assignment, weights=weight_matrix[task_ids, assignment], minlength=n_agents)
+        budgets = np.concatenate(([objective - min_objective], capacities - loads.astype(int)))
+
+        print('Exchanges: %d' % (2 * len(pairs)))
+
+        affinity_improvement, selected, duration, optimal = exchange_solver.solve(
+            aff_improv[move_tasks, dest_agents], weights, budgets, move_tasks, timeout=self.timeout)
+        nb_exchanges = np.count_nonzero(selected)
+
+        print('Applied Exchanges: %d / Improvement: %d / Time: %.3f / Optimal: %s' % (
+            nb_exchanges, affinity_improvement, duration, optimal))
+
+        if nb_exchanges == 0:
+            return initial_assignment, objective
+
+        assignment[move_tasks[selected]] = dest_agents[selected]
+
+        new_objective = profit_matrix[task_ids, assignment].sum()
+        new_loads = np.bincount(assignment, weights=weight_matrix[task_ids, assignment], minlength=n_agents)
+
+        _, _, _, compat = cycle_matrices(agents, tasks)
+        assert (check_assignment(compat, assignment))
+        assert (aff_mat[task_ids, assignment].sum() == initial_affinities.sum() + affinity_improvement)
+        assert (np.all(new_loads <= capacities))
+        assert (new_objective >= min_objective)
+
+        return assignment, new_objective
 
     def __str__(self):
         return 'exchange%d' % int(self.acceptance_ratio * 100)
 
 
+class LocalSearchNegotiation(Negotiation):
+    """
+    Hill climbing on the affinity within the profit bound, until no improving step is left or the time is up.
+    Steps are single moves of a task to another agent, or ejection chains: a task moves to a full agent, which
+    passes on one of its tasks to a third agent, back to the first agent (a swap) or leaves it unassigned.
+    Deltas of affinity, profit and loads are evaluated for all steps of the current assignment at once.
+    """
+
+    def __init__(self, acceptance_ratio=0.6, timeout=1):
+        super().__init__(acceptance_ratio)
+        self.timeout = timeout
+
+    def exchange(self, agents, tasks, profits, initial_assignment, objective):
+        start = time.time()
+        min_objective = int(objective * self.acceptance_ratio)
+
+        print('Objective: %d / Bound: %d' % (objective, min_objective))
+
+        capacities = np.array([0] + [a.capacity for a in agents])
+
+        profit_matrix, aff_mat, weight_matrix = matrizes(agents, tasks, pad_dummy_agent=True)
+        _, _, _, compat = cycle_matrices(agents, tasks)
+        compat = np.hstack((np.zeros((len(tasks), 1), dtype=bool), compat))
+        assignment = np.array(initial_assignment, dtype=int)
+        task_ids = np.arange(len(tasks))
+
+        initial_affinities = aff_mat[task_ids, assignment].sum()
+        loads = np.bincount(assignment, weights=weight_matrix[task_ids, assignment],
+                            minlength=len(capacities)).astype(int)
+        new_objective = objective
+        nb_moves = nb_chains = 0
+        timed_out = False
+
+        while True:
+            if time.time() - start > self.timeout:
+                timed_out = True
+                break
+
+            aff_delta = aff_mat - aff_mat[task_ids, assignment][:, np.newaxis]
+            prof_delta = profit_matrix - profit_matrix[task_ids, assignment][:, np.newaxis]
+            improving = compat & (aff_delta > 0) & (new_objective + prof_delta >= min_objective)
+
+            # 1. Best single move
+            moves = improving & (loads + weight_matrix <= capacities)
+
+            if moves.any():
+                task, dest = np.unravel_index(np.argmax(np.where(moves, aff_delta, 0)), moves.shape)
+                new_objective += prof_delta[task, dest]
+                self.move(assignment, loads, weight_matrix, task, dest)
+                nb_moves += 1
+                continue
+
+            # 2. First ejection chain, starting with the best moves
+            candidates = np.flatnonzero(improving)
+            candidates = candidates[np.argsort(-aff_delta.flat[candidates], kind='stable')]
+            chain = None
+
+            for task, dest in zip(*np.unravel_index(candidates, improving.shape)):
+                if time.time() - start > self.timeout:
+                    break
+
+                chain = self.ejection(assignment, loads, capacities, profit_matrix, aff_mat, weight_matrix, compat,
+                                      task, dest, aff_delta[task, dest], new_objective + prof_delta[task, dest] -
+                                      min_objective)
+
+                if chain is not None:
+                    break
+
+            if chain is None:
+                timed_out = time.time() - start > self.timeout
+                break
+
+            ejected, target = chain
+            new_objective += prof_delta[task, dest] + profit_matrix[ejected, target] - profit_matrix[ejected, dest]
+            self.move(assignment, loads, weight_matrix, task, dest)
+            self.move(assignment, loads, weight_matrix, ejected, target)
+            nb_chains += 1
+
+        _, _, _, cycle_compat = cycle_matrices(agents, tasks)
+        assert (check_assignment(cycle_compat, assignment))
+        assert (np.all(loads <= capacities))
+        assert (new_objective == profit_matrix[task_ids, assignment].sum())
+        assert (new_objective >= min_objective)
+
+        aff_improvement = aff_mat[task_ids, assignment].sum() - initial_affinities
+        print('Moves: %d / Chains: %d / Aff. Improved: %d / Objective decreased: %d / Time: %.3f / Timeout: %s' % (
+            nb_moves, nb_chains, aff_improvement, new_objective - objective, time.time() - start, timed_out))
+
+        return assignment, new_objective
+
+    @staticmethod
+    def move(assignment, loads, weight_matrix, task, dest):
+        """ Moves the task and updates the loads in place """
+        source = assignment[task]
+        loads[source] -= weight_matrix[task, source]
+        loads[dest] += weight_matrix[task, dest]
+        assignment[task] = dest
+
+    @staticmethod
+    def ejection(assignment, loads, capacities, profit_matrix, aff_mat, weight_matrix, compat, task, dest,
+                 aff_gain, profit_slack):
+        """
+        Best task to eject from `dest` when `task` moves there, as (ejected task, its new agent) or None.
+        The ejected task may go to any other compatible agent with enough capacity, or stay unassigned (agent 0).
+        The chain must improve the affinity in total and keep the profit slack non-negative.
+        """
+        source = assignment[task]
+        ejectable = np.flatnonzero(assignment == dest)
+        overload = loads[dest] + weight_matrix[task, dest] - capacities[dest]
+        ejectable = ejectable[weight_matrix[ejectable, dest] >= overload]
+
+        if len(ejectable) == 0:
+            return None
+
+        new_loads = loads.copy()
+        new_loads[source] -= weight_matrix[task, source]
+        new_loads[0] = 0
+
+        targets = compat[ejectable] & (new_loads + weight_matrix[ejectable] <= capacities)
+        targets[:, 0] = True
+        targets[:, dest] = False
+
+        gain = aff_gain + aff_mat[ejectable] - aff_mat[ejectable, dest][:, np.newaxis]
+        slack = profit_slack + profit_matrix[ejectable] - profit_matrix[ejectable, dest][:, np.newaxis]
+        valid = targets & (gain > 0) & (slack >= 0)
+
+        if not valid.any():
+            return None
+
+        row, target = np.unravel_index(np.argmax(np.where(valid, gain, np.iinfo(gain.dtype).min)), valid.shape)
+        return ejectable[row], target
+
+    def __str__(self):
+        return 'localsearch%d' % int(self.acceptance_ratio * 100)
+
+
 STRATEGY_MAPPING = {
     'profit': ProfitStrategy,
     'affinity': AffinityStrategy,
@@ -475,5 +577,6 @@ STRATEGY_MAPPING = {
     'productcomb': ProductCombinationStrategy,
     'wpp': WeightedPartialProfits,
     'negotiation': OneSwapNegotiation,
-    'exchange': SolverNegotiation
+    'exchange': SolverNegotiation,
+    'localsearch': LocalSearchNegotiation
 }
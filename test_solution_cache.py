@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+pytest.importorskip('pymzn')
+
+import main
+import strategies
+from problem import CachedSolutions, MaxAssignmentGreedy, MaxAssignmentMilp, Portfolio
+
+INSTANCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instances',
+                        'a5_t20_c100_aa1.00_ta0.50_ass1.00_su_1.pl')
+
+
+@pytest.mark.parametrize('backend', [
+    lambda: MaxAssignmentMilp(timeout=5),
+    lambda: Portfolio([MaxAssignmentMilp(), MaxAssignmentGreedy()], timeout=5),
+])
+def test_second_run_hits(tmp_path, backend):
+    """ A second identical run takes all cycles from the cache, whatever the first run left in its backend """
+    cache_dir = str(tmp_path / 'cache')
+    runs = []
+
+    for run in range(2):
+        output_dir = tmp_path / ('run%d' % run)
+        output_dir.mkdir()
+        problem = CachedSolutions(backend(), cache_dir)
+        main.main(INSTANCE, strategies.STRATEGY_MAPPING['switch'](5), problem, str(output_dir))
+        runs.append(problem.cache)
+
+    assert runs[0].hits == 0 and runs[0].misses > 0
+    assert runs[1].misses == 0 and runs[1].hits == runs[0].misses